@@ -34,6 +34,9 @@ xdg_config_home = os.environ.get('XDG_CONFIG_HOME',
 xdg_config_dirs = [xdg_config_home] + \
 	os.environ.get('XDG_CONFIG_DIRS', '/etc/xdg').split(':')
 
+xdg_cache_home = os.environ.get('XDG_CACHE_HOME',
+			os.path.join(_home, '.cache'))
+
 xdg_data_dirs = filter(lambda x: x, xdg_data_dirs)
 xdg_config_dirs = filter(lambda x: x, xdg_config_dirs)
 
@@ -61,6 +64,17 @@ def save_data_path(*resource):
 		os.makedirs(path)
 	return path
 
+def save_cache_path(*resource):
+	"""Ensure $XDG_CACHE_HOME/<resource>/ exists, and return its path.
+	'resource' should normally be the name of your application. Use this
+	for data which can be regenerated if it is lost."""
+	resource = os.path.join(*resource)
+	assert not resource.startswith('/')
+	path = os.path.join(xdg_cache_home, resource)
+	if not os.path.isdir(path):
+		os.makedirs(path)
+	return path
+
 def load_config_paths(*resource):
 	"""Returns an iterator which gives each directory named 'resource' in the
 	configuration search path. Information provided by earlier directories should
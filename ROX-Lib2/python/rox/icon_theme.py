@@ -3,11 +3,22 @@ that replace those defined here."""
 from __future__ import generators
 
 import os
+import time
+import mmap
+import struct
 import basedir
 import rox
+from rox.lru import LRUCache
 
-theme_dirs = [os.path.join(os.environ.get('HOME', '/'), '.icons')] + \
-		list(basedir.load_data_paths('icons'))
+theme_dirs = None	# Directories to search for themes; see _get_theme_dirs()
+
+def _get_theme_dirs():
+	"""Return theme_dirs, finding them the first time."""
+	global theme_dirs
+	if theme_dirs is None:
+		theme_dirs = [os.path.join(os.environ.get('HOME', '/'), '.icons')] + \
+				list(basedir.load_data_paths('icons'))
+	return theme_dirs
 
 def _ini_parser(stream):
 	"""Yields a sequence of (section, key, value) triples."""
@@ -24,10 +35,81 @@ def _ini_parser(stream):
 			raise Exception("Error in file '%s': Expected '[SECTION]' but got '%s'" %
 					(stream, line))
 
+class IconCache:
+	"""A theme's icon-theme.cache file, as written by gtk-update-icon-cache.
+	The file is memory-mapped and icons are looked up in its hash table
+	directly, without listing or stat'ing the theme's directories."""
+	_extensions = ((4, 'png'), (2, 'svg'))	# Flag, in order of preference
+
+	def __init__(self, path):
+		f = file(path, 'rb')
+		try:
+			self.buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		finally:
+			f.close()
+		self.path = path
+
+		major, minor, self.hash, dir_list = struct.unpack_from('>HHLL',
+								      self.buf, 0)
+		if major != 1:
+			raise Exception('Unsupported icon-theme.cache version %d.%d' %
+					(major, minor))
+		n = struct.unpack_from('>L', self.buf, dir_list)[0]
+		self.dirs = [self._string(offset) for offset in
+			     struct.unpack_from('>%dL' % n, self.buf, dir_list + 4)]
+		self.n_buckets = struct.unpack_from('>L', self.buf, self.hash)[0]
+
+	def _string(self, offset):
+		"""Get the nul-terminated string at offset"""
+		return self.buf[offset:self.buf.find('\0', offset)]
+
+	def get_icon(self, iconname):
+		"""Return a dictionary mapping the names of the directories which
+		have this icon to its extension, or None if there are none.
+		Like Index.get_icon()."""
+		if not self.n_buckets:
+			return None
+		# GTK's icon_name_hash(), which uses signed chars
+		h = 0
+		for c in iconname:
+			c = ord(c)
+			if c > 127: c -= 256
+			h = (h * 31 + c) & 0xffffffff
+		icon = struct.unpack_from('>L', self.buf,
+				self.hash + 4 + 4 * (h % self.n_buckets))[0]
+		while icon != 0xffffffff:
+			chain, name, images = struct.unpack_from('>LLL',
+								 self.buf, icon)
+			if self._string(name) == iconname:
+				break
+			icon = chain
+		else:
+			return None
+		found = {}
+		n = struct.unpack_from('>L', self.buf, images)[0]
+		for i in range(n):
+			dir, flags = struct.unpack_from('>HH', self.buf,
+							images + 4 + 8 * i)
+			for flag, extension in self._extensions:
+				if flags & flag:
+					found[self.dirs[dir]] = extension
+					break
+		return found or None
+
 class Index:
-	"""A theme's index.theme file."""
+	"""A theme's index.theme file. The icons in the theme's subdirectories
+	are looked up in its icon-theme.cache if that is up-to-date, or else
+	listed when first needed. Either is done again if the directories
+	change."""
+	check_interval = 5	# Seconds between checks for changes
+
 	def __init__(self, dir):
 		self.dir = dir
+		self._icons = None	# Icon name -> {subdir name: extension}
+		self._cache = None	# IconCache, used instead of _icons
+		self._mtimes = None	# Of the directories, when loaded
+		self._checked = 0	# time.time() of the last check
+		self._by_size = {}	# Size -> [(diff, subdir name)]
 		self.sections = {}
 		for section, key, value in _ini_parser(file(os.path.join(dir, "index.theme"))):
 			try:
@@ -47,6 +129,81 @@ class Index:
 		"None if not found"
 		return self.sections.get(section, {}).get(key, None)
 
+	def _get_mtimes(self):
+		"""The mtimes of the theme directory, its subdirectories and its
+		icon-theme.cache (None for any which are missing)."""
+		mtimes = []
+		for d in [''] + [d.name for d in self.subdirs] + ['icon-theme.cache']:
+			try:
+				mtimes.append(os.stat(os.path.join(self.dir, d)).st_mtime)
+			except OSError:
+				mtimes.append(None)
+		return mtimes
+
+	def _load(self):
+		"""Use the icon-theme.cache if it is at least as new as all the
+		directories. Otherwise, list every subdirectory, once."""
+		self._mtimes = mtimes = self._get_mtimes()
+		self._cache = self._icons = None
+		cache_mtime = mtimes[-1]
+		if cache_mtime is not None and \
+		   max(mtimes[:-1]) <= cache_mtime:
+			try:
+				self._cache = IconCache(os.path.join(self.dir,
+							'icon-theme.cache'))
+				return
+			except:
+				pass
+		icons = {}
+		for d in self.subdirs:
+			try:
+				leaves = os.listdir(os.path.join(self.dir, d.name))
+			except OSError:
+				continue
+			for leaf in leaves:
+				name, ext = os.path.splitext(leaf)
+				if ext == '.png':
+					icons.setdefault(name, {})[d.name] = 'png'
+				elif ext == '.svg':
+					icons.setdefault(name, {}).setdefault(d.name, 'svg')
+		self._icons = icons
+
+	def get_icon(self, iconname):
+		"""Return a dictionary mapping the names of the subdirectories
+		which have this icon to its extension ('png' if there is more
+		than one), or None if the theme doesn't have it."""
+		now = time.time()
+		if self._mtimes is None:
+			self._load()
+			self._checked = now
+		elif now - self._checked > self.check_interval:
+			self._checked = now
+			if self._get_mtimes() != self._mtimes:
+				self._load()
+		if self._cache:
+			return self._cache.get_icon(iconname)
+		return self._icons.get(iconname, None)
+
+	def subdirs_for_size(self, size):
+		"""Return a list of (diff, subdir name) pairs, nearest size first,
+		where diff is how far the subdirectory's icons are from size."""
+		try:
+			return self._by_size[size]
+		except KeyError:
+			pass
+		dirs = []
+		for d in self.subdirs:
+			if size < d.min_size:
+				diff = d.min_size - size
+			elif size > d.max_size:
+				diff = size - d.max_size
+			else:
+				diff = 0
+			dirs.append((diff, d.name))
+		dirs.sort()
+		self._by_size[size] = dirs
+		return dirs
+
 class SubDir:
 	"""A subdirectory within a theme."""
 	def __init__(self, index, subdir):
@@ -91,8 +248,12 @@ class IconThemeROX(IconTheme):
 
 		IconTheme.__init__(self, name)
 
+		self._chain = None	# This theme, the ones it inherits from, hicolor
+		self._missing = LRUCache(1000)	# (name, size) not in any of them
+		self._missing_checked = 0
+
 		self.indexes = []
-		for leaf in theme_dirs:
+		for leaf in _get_theme_dirs():
 			theme_dir = os.path.join(leaf, name)
 			index_file = os.path.join(theme_dir, 'index.theme')
 			if os.path.exists(os.path.join(index_file)):
@@ -100,42 +261,73 @@ class IconThemeROX(IconTheme):
 					self.indexes.append(Index(theme_dir))
 				except:
 					rox.report_exception()
+
+	def get_inherits(self):
+		"""Return the names of the themes this one inherits from."""
+		for i in self.indexes:
+			inherits = i.get('Icon Theme', 'Inherits')
+			if inherits:
+				return [n.strip() for n in inherits.split(',') if n.strip()]
+		return []
+
+	def get_chain(self):
+		"""Return the list of themes to search, in order: this one, the
+		themes it inherits from (depth first) and finally hicolor. Themes
+		without any directories are left out."""
+		if self._chain is not None:
+			return self._chain
+		chain = []
+		seen = {}
+		def add(theme):
+			if theme.name in seen: return
+			seen[theme.name] = True
+			if theme.indexes:
+				chain.append(theme)
+			for parent in theme.get_inherits():
+				add(_get_rox_theme(parent))
+		add(self)
+		add(_get_rox_theme('hicolor'))
+		self._chain = chain
+		return chain
 	
 	def lookup_icon(self, iconname, size, flags=0):
-		icon = self._lookup_this_theme(iconname, size)
-		if icon: return icon
-		# XXX: inherits
+		# Misses are remembered for as long as the indexes would
+		# assume the directories haven't changed.
+		now = time.time()
+		if now - self._missing_checked > Index.check_interval:
+			self._missing.clear()
+			self._missing_checked = now
+		key = (iconname, size)
+		if self._missing.get(key):
+			return None
+		for theme in self.get_chain():
+			icon = theme._lookup_this_theme(iconname, size)
+			if icon: return icon
+		self._missing[key] = True
+		return None
 	
 	def _lookup_this_theme(self, iconname, size):
-		dirs = []
+		# Take the closest size from any of the theme's directories
+		best = None
 		for i in self.indexes:
-			for d in i.subdirs:
-				if size < d.min_size:
-					diff = d.min_size - size
-				elif size > d.max_size:
-					diff = size - d.max_size
-				else:
-					diff = 0
-				dirs.append((diff, os.path.join(i.dir, d.name)))
-
-		# Sort by closeness of size
-		dirs.sort()
-
-		for _, subdir in dirs:
-			for extension in ("png", "svg"):
-				filename = os.path.join(subdir,
-					iconname + '.' + extension)
-				if os.path.exists(filename):
-					return filename
-		return None
+			found = i.get_icon(iconname)
+			if not found:
+				continue
+			for diff, name in i.subdirs_for_size(size):
+				if name in found:
+					subdir = os.path.join(i.dir, name)
+					if best is None or (diff, subdir) < best[:2]:
+						best = (diff, subdir, found[name])
+					break
+		if best is None:
+			return None
+		diff, subdir, extension = best
+		return os.path.join(subdir, iconname + '.' + extension)
 
 	def load_icon(self, iconname, size, flags=0):
 		path=self.lookup_icon(iconname, size, flags)
 		if path:
-			if hasattr(rox.g.gdk, 'pixbuf_new_from_file_at_size'):
-				return rox.g.gdk.pixbuf_new_from_file_at_size(path, size, size)
-			else:
-				return rox.g.gdk.pixbuf_new_from_file(path)
+			return load_pixbuf(path, size, flags)
 		return None
 
 class IconThemeGTK(IconTheme):
@@ -164,6 +356,67 @@ class IconThemeGTK(IconTheme):
 	def load_icon(self, iconname, size, flags=0):
 		return self.gtk_theme.load_icon(iconname, size, flags)
 
+def _pixbuf_bytes(pixbuf):
+	return pixbuf.get_rowstride() * pixbuf.get_height()
+
+_pixbuf_cache = LRUCache(4 << 20, _pixbuf_bytes)
+
+def load_pixbuf(path, size=None, flags=0, width=None):
+	"""Return a pixbuf for the image file at path, loaded to fit in size
+	by size pixels (or at its natural size if size is None), and then
+	scaled to be width pixels wide if width is given. The pixbufs are
+	shared through a cache, so don't change them."""
+	key = (path, size, flags, width)
+	cache = _pixbuf_cache
+	if cache is not None:
+		pixbuf = cache.get(key)
+		if pixbuf is not None:
+			return pixbuf
+	if width:
+		base = load_pixbuf(path, size, flags)
+		h = int(base.get_height()*float(width)/base.get_width())
+		pixbuf = base.scale_simple(width, h, rox.g.gdk.INTERP_BILINEAR)
+	elif size and hasattr(rox.g.gdk, 'pixbuf_new_from_file_at_size'):
+		pixbuf = rox.g.gdk.pixbuf_new_from_file_at_size(path, size, size)
+	else:
+		pixbuf = rox.g.gdk.pixbuf_new_from_file(path)
+	if cache is not None:
+		cache[key] = pixbuf
+	return pixbuf
+
+def set_pixbuf_cache(max_bytes):
+	"""Limit the pixbufs kept by load_pixbuf() to max_bytes of image
+	data (4 MB by default). Use 0 to disable the cache."""
+	global _pixbuf_cache
+	if max_bytes:
+		_pixbuf_cache = LRUCache(max_bytes, _pixbuf_bytes)
+	else:
+		_pixbuf_cache = None
+
+def get_pixbuf_cache_stats():
+	"""Return a dictionary with the 'hits', 'misses', 'evictions', 'size'
+	(number of pixbufs), 'used' and 'capacity' (bytes) of the pixbuf
+	cache, or None if it is disabled."""
+	if _pixbuf_cache is None:
+		return None
+	return _pixbuf_cache.stats()
+
+def clear_pixbuf_cache():
+	"""Forget all the cached pixbufs, eg because the theme has changed."""
+	if _pixbuf_cache is not None:
+		_pixbuf_cache.clear()
+
+_rox_themes = {}	# Name -> IconThemeROX, for inherited themes
+
+def _get_rox_theme(name):
+	"""Return the shared IconThemeROX for name, used when another theme
+	inherits from it."""
+	try:
+		return _rox_themes[name]
+	except KeyError:
+		theme = _rox_themes[name] = IconThemeROX(name)
+		return theme
+
 def get_theme(name=None):
 	try:
 		theme=IconThemeGTK(name)
@@ -172,12 +425,36 @@ def get_theme(name=None):
 		
 	return theme
 	
-rox_theme = get_theme('ROX')
-try:
-	from rox import options
-	ogrp=options.OptionGroup('ROX-Filer', 'Options', 'rox.sourceforge.net')
-	theme_name = options.Option('icon_theme', 'ROX', ogrp)
-	ogrp.notify(warn_unused=False)
-	users_theme = get_theme(theme_name.value)
-except:
-	users_theme = rox_theme
+class _LazyTheme:
+	"""Stands in for a theme, which is only made (by calling load) when
+	it is first used. Nothing is read when this module is imported."""
+	def __init__(self, load):
+		self._load = load
+		self._theme = None
+
+	def _get(self):
+		if self._theme is None:
+			self._theme = self._load()
+		return self._theme
+
+	def __getattr__(self, name):
+		return getattr(self._get(), name)
+
+def _load_users_theme():
+	try:
+		from rox import options
+		ogrp=options.OptionGroup('ROX-Filer', 'Options', 'rox.sourceforge.net')
+		theme_name = options.Option('icon_theme', 'ROX', ogrp)
+		def theme_changed():
+			if theme_name.has_changed:
+				users_theme._theme = get_theme(theme_name.value)
+				clear_pixbuf_cache()
+		ogrp.notify(warn_unused=False)
+		theme = get_theme(theme_name.value)
+		ogrp.add_notify(theme_changed)
+		return theme
+	except:
+		return rox_theme._get()
+
+rox_theme = _LazyTheme(lambda: get_theme('ROX'))
+users_theme = _LazyTheme(_load_users_theme)
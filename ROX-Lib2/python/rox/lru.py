@@ -0,0 +1,140 @@
+"""A bounded cache which discards the least recently used items when it is
+full. This is used by rox.mime to remember the results of lookups, but may
+be useful elsewhere too.
+
+Typical usage:
+
+	from rox.lru import LRUCache
+	cache = LRUCache(1000)
+	cache[key] = value
+	value = cache.get(key)		# None if not cached
+
+To limit the total size of the values instead of their number, pass a
+function giving the size of a value:
+
+	cache = LRUCache(4 << 20, lambda s: len(s))	# 4 MB of strings
+"""
+
+# Indexes into the links of the recently-used list
+_PREV, _NEXT, _KEY, _VALUE = range(4)
+
+class LRUCache:
+	"""A mapping holding at most 'capacity' items. Adding an item to a
+	full cache discards the least recently used one. The counters 'hits'
+	and 'misses' record the results of get(), and 'evictions' counts
+	discarded items.
+	If sizeof is given, capacity is instead the limit on the total of
+	sizeof(value) for the items held, which is kept in 'used'. An item
+	bigger than that is discarded at once."""
+
+	def __init__(self, capacity, sizeof = None):
+		self.capacity = capacity
+		self.sizeof = sizeof
+		self.used = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._map = {}		# key -> link
+		# Circular doubly-linked list, most recently used at the end
+		self._root = root = []
+		root[:] = [root, root, None, None]
+
+	def _unlink(self, link):
+		link[_PREV][_NEXT] = link[_NEXT]
+		link[_NEXT][_PREV] = link[_PREV]
+
+	def _append(self, link):
+		root = self._root
+		last = root[_PREV]
+		link[_PREV] = last
+		link[_NEXT] = root
+		last[_NEXT] = root[_PREV] = link
+
+	def get(self, key, default = None, valid = None):
+		"""Return the value for key, marking it as recently used, or
+		default if it isn't cached. If valid is given, it is called with
+		the value and a false result means the value is out of date; it
+		is then counted as a miss and default is returned."""
+		link = self._map.get(key, None)
+		if link is None or (valid is not None and not valid(link[_VALUE])):
+			self.misses += 1
+			return default
+		self.hits += 1
+		self._unlink(link)
+		self._append(link)
+		return link[_VALUE]
+
+	def _size(self, link):
+		if self.sizeof is None:
+			return 1
+		return self.sizeof(link[_VALUE])
+
+	def __setitem__(self, key, value):
+		link = self._map.get(key, None)
+		if link is not None:
+			self._unlink(link)
+			self.used -= self._size(link)
+		else:
+			link = [None, None, key, None]
+			self._map[key] = link
+		link[_VALUE] = value
+		size = self._size(link)
+		if size > self.capacity:
+			# Don't throw everything else away for it
+			del self._map[key]
+			self.evictions += 1
+			return
+		self.used += size
+		self._append(link)
+		while self.used > self.capacity:
+			oldest = self._root[_NEXT]
+			self._unlink(oldest)
+			del self._map[oldest[_KEY]]
+			self.used -= self._size(oldest)
+			self.evictions += 1
+
+	def __getitem__(self, key):
+		link = self._map[key]
+		self._unlink(link)
+		self._append(link)
+		return link[_VALUE]
+
+	def __delitem__(self, key):
+		link = self._map.pop(key)
+		self._unlink(link)
+		self.used -= self._size(link)
+
+	def __contains__(self, key):
+		return key in self._map
+
+	def __len__(self):
+		return len(self._map)
+
+	def keys(self):
+		"""Keys, least recently used first."""
+		keys = []
+		link = self._root[_NEXT]
+		while link is not self._root:
+			keys.append(link[_KEY])
+			link = link[_NEXT]
+		return keys
+
+	def clear(self):
+		"""Remove all items. The counters are not reset."""
+		self._map.clear()
+		self.used = 0
+		root = self._root
+		root[:] = [root, root, None, None]
+
+	def stats(self):
+		"""Return a dictionary of the cache's counters (and 'used', if
+		there is a sizeof function)."""
+		stats = {'size': len(self._map), 'capacity': self.capacity,
+			 'hits': self.hits, 'misses': self.misses,
+			 'evictions': self.evictions}
+		if self.sizeof is not None:
+			stats['used'] = self.used
+		return stats
+
+	def __repr__(self):
+		return '<LRUCache %d/%d>' % (len(self._map), self.capacity)
@@ -1,7 +1,8 @@
 """This module provides access to the shared MIME database.
 
-types is a dictionary of all known MIME types, indexed by the type name, e.g.
-types['application/x-python']
+types is a dictionary of the MIME types which have been looked up so far,
+indexed by (media, subtype), e.g. types[('application', 'x-python')]. Use
+lookup() to get a type object.
 
 Applications can install information about MIME types by storing an
 XML file as <MIME>/packages/<application>.xml and running the
@@ -13,7 +14,14 @@ information about the format of these files."""
 
 import os
 import stat
+import errno
+import time
 import fnmatch
+import re
+import mmap
+import struct
+from array import array
+from binascii import hexlify
 
 import rox
 import rox.choices
@@ -31,10 +39,13 @@ ICON_SIZE_LARGE=52
 ICON_SIZE_SMALL=18
 ICON_SIZE_UNSCALED=None
 
-exts = None		# Maps extensions to types
-globs = None		# List of (glob, type) pairs
-literals = None		# Maps liternal names to types
+exts = None		# Maps (lowercase) extensions to types
+globs = None		# GlobMatcher for all other patterns
+literals = None		# Maps (lowercase) literal names to types
+case_exts = None	# Maps case-sensitive extensions to types
+case_literals = None	# Maps case-sensitive literal names to types
 magic = None
+caches = None		# List of MIMECache objects, in data dir order
 
 def _get_node_data(node):
 	"""Get text of XML node"""
@@ -78,10 +89,61 @@ class MIMEtype:
 		"""Returns comment for current language, loading it if needed."""
 		# Should we ever reload?
 		if self._comment is None:
-			self._comment = (0, str(self))
-			self._load()
+			comment = _get_comments().get(str(self), None)
+			if comment:
+				self._comment = (2, comment)
+			else:
+				self._comment = (0, str(self))
+				self._load()
 		return self._comment[1]
 
+	def get_canonical(self):
+		"""If this type is an alias, return the type it is an alias
+		for. Otherwise, return this type."""
+		name = str(self)
+		canonical = _get_hierarchy()[1].get(name, name)
+		if canonical == name:
+			return self
+		return lookup(canonical)
+
+	def get_parents(self):
+		"""Return a list of the types this type is declared to be a
+		subclass of (eg, text/plain for application/x-python)."""
+		name = str(self.get_canonical())
+		return [lookup(p) for p in _get_hierarchy()[0].get(name, ())]
+
+	def get_ancestors(self):
+		"""Return a list of all the types this type is declared to be a
+		subclass of, directly or indirectly, nearest first."""
+		name = str(self.get_canonical())
+		return [lookup(p) for p in _get_hierarchy()[2].get(name, ())]
+
+	def is_subclass_of(self, other):
+		"""True if this type is the same as 'other', is an alias of it or
+		is a subclass of it. 'other' may be a type or a type name, and may
+		be of the form 'media/*'. Following the spec, all text types are
+		subclasses of text/plain and everything except inode types is a
+		subclass of application/octet-stream."""
+		parents, aliases, ancestors, closure = _get_hierarchy()
+		name = str(self)
+		name = aliases.get(name, name)
+		other = str(other)
+		other = aliases.get(other, other)
+		if name == other or other in closure.get(name, ()):
+			return True
+		if other.endswith('/*'):
+			media = other[:-2]
+			if self.media == media:
+				return True
+			for t in ancestors.get(name, ()):
+				if t.startswith(media + '/'):
+					return True
+		if other == 'text/plain' and self.media == 'text':
+			return True
+		if other == 'application/octet-stream' and self.media != 'inode':
+			return True
+		return False
+
 	def __str__(self):
 		return self.media + '/' + self.subtype
 
@@ -95,16 +157,179 @@ class MIMEtype:
 		at the correct aspect ratio.  The constants
 		ICON_SIZE_{HUGE,LARGE,SMALL} match the sizes used by the
 		filer."""
-		base=image_for_type(self.media + '/' + self.subtype)
-		if not base or not size:
-			return base
+		from icon_theme import load_pixbuf
+		path=_icon_path_for_type(self.media + '/' + self.subtype, 48, 0)
+		if not path:
+			return None
+		return load_pixbuf(path, 48, 0, size or None)
+
+_comments = None		# Maps type names to comments, for the current language
+_hierarchy = None	# (parents, aliases, ancestors, closure); see _get_hierarchy()
+
+def _get_hierarchy():
+	"""Return the type hierarchy, loading it if needed, as a tuple of
+	dictionaries keyed on type names:
+	parents   - tuple of declared parent names
+	aliases   - canonical name (for aliases only)
+	ancestors - tuple of all ancestor names, nearest first
+	closure   - frozenset of the ancestor names, for is_subclass_of()
+	Names are interned, and the closure is computed once when the
+	hierarchy is loaded, so lookups need no further work."""
+	global _hierarchy
+	if not _cache_uptodate:
+		_cache_database()
+	if _hierarchy is not None:
+		return _hierarchy
+
+	parents = {}
+	aliases = {}
+	def add_parent(child, parent):
+		child = intern(child)
+		old = parents.get(child, ())
+		if parent not in old:
+			parents[child] = old + (intern(parent),)
+
+	for cache in caches:
+		for alias, canonical in cache.get_aliases().iteritems():
+			aliases.setdefault(intern(alias), intern(canonical))
+		for child, ps in cache.get_parents().iteritems():
+			for parent in ps:
+				add_parent(child, parent)
+	for mime_dir in _text_dirs:
+		for leaf, add in (('aliases', aliases.setdefault),
+				  ('subclasses', add_parent)):
+			path = os.path.join(mime_dir, leaf)
+			if not os.path.exists(path):
+				continue
+			for line in file(path):
+				line = line.split()
+				if len(line) == 2:
+					add(intern(line[0]), intern(line[1]))
+
+	ancestors = {}
+	closure = {}
+	for child in parents:
+		found = []
+		queue = [child]
+		while queue:
+			for parent in parents.get(queue.pop(0), ()):
+				parent = aliases.get(parent, parent)
+				if parent != child and parent not in found:
+					found.append(parent)
+					queue.append(parent)
+		ancestors[child] = tuple(found)
+		closure[child] = frozenset(found)
+	_hierarchy = (parents, aliases, ancestors, closure)
+	return _hierarchy
+
+def resolve_alias(name):
+	"""Return the canonical name for the type called 'name' (which is
+	'name' itself unless it is an alias)."""
+	return _get_hierarchy()[1].get(name, name)
+
+def _package_files():
+	"""List (path, mtime) for every package file, in data dir order."""
+	files = []
+	for packages in basedir.load_data_paths('mime', 'packages'):
+		leaves = os.listdir(packages)
+		leaves.sort()
+		for leaf in leaves:
+			if leaf.endswith('.xml'):
+				path = os.path.join(packages, leaf)
+				try:
+					files.append((path, os.stat(path).st_mtime))
+				except OSError:
+					pass
+	return files
+
+def _read_package_comments(path, comments):
+	"""Add the comments from the package file 'path' to 'comments', which
+	maps type names to (goodness, comment) pairs. Uses expat, so the
+	document is never held in memory as a tree."""
+	from xml.parsers import expat
+	parser = expat.ParserCreate(namespace_separator = ' ')
+	mime_type_tag = FREE_NS + ' mime-type'
+	comment_tag = FREE_NS + ' comment'
+	lang_attr = XML_NAMESPACE + ' lang'
+	stack = []
+	text = []
+	state = {}
+
+	def start(name, attrs):
+		if name == mime_type_tag:
+			state['type'] = attrs.get('type', None)
+		elif name == comment_tag and stack and stack[-1] == mime_type_tag:
+			state['lang'] = attrs.get(lang_attr, 'en')
+			del text[:]
+		stack.append(name)
+
+	def end(name):
+		stack.pop()
+		type_name = state.get('type', None)
+		if name == comment_tag and type_name and \
+		   stack and stack[-1] == mime_type_tag:
+			goodness = 1 + (state['lang'] in i18n.langs)
+			if goodness > comments.get(type_name, (0,))[0]:
+				comments[type_name] = (goodness, ''.join(text).strip())
+
+	def data(s):
+		text.append(s)
+
+	parser.StartElementHandler = start
+	parser.EndElementHandler = end
+	parser.CharacterDataHandler = data
+	parser.ParseFile(file(path, 'rb'))
+
+def _get_comments():
+	"""Return the comment index, which maps type names to comments in the
+	current language. It is built from all the package files at once and
+	saved in XDG_CACHE_HOME, so later runs just load it from there."""
+	global _comments
+	if _comments is not None:
+		return _comments
+
+	import marshal
+	stamp = (1, i18n.langs, _package_files())
+	cache_file = os.path.join(basedir.xdg_cache_home,
+				  'rox.sourceforge.net', 'mime-comments')
+	try:
+		saved_stamp, comments = marshal.loads(file(cache_file, 'rb').read())
+		if saved_stamp == stamp:
+			_comments = comments
+			return _comments
+	except:
+		pass
 
-		h=int(base.get_height()*float(size)/base.get_width())
-		return base.scale_simple(size, h, rox.g.gdk.INTERP_BILINEAR)
+	found = {}
+	for path, mtime in stamp[2]:
+		try:
+			_read_package_comments(path, found)
+		except:
+			pass
+	_comments = dict([(t, c[1]) for t, c in found.iteritems()])
+
+	try:
+		tmp = cache_file + '.new%d' % os.getpid()
+		basedir.save_cache_path('rox.sourceforge.net')
+		file(tmp, 'wb').write(marshal.dumps((stamp, _comments)))
+		os.rename(tmp, cache_file)
+	except (IOError, OSError):
+		pass
+	return _comments
 
 def image_for_type(type, size=48, flags=0):
 	'''Search XDG_CONFIG or icon theme for a suitable icon. Returns a
-	pixbuf, or None.'''
+	pixbuf, or None. The pixbuf may be shared with other callers (see
+	icon_theme.load_pixbuf()), so don't change it.'''
+	from icon_theme import load_pixbuf
+	path=_icon_path_for_type(type, size, flags)
+	if path:
+		return load_pixbuf(path, size, flags)
+	else:
+		return None
+
+def _icon_path_for_type(type, size, flags):
+	"""The path of the icon image_for_type() would load, or None."""
 	from icon_theme import users_theme
 	
 	media, subtype = type.split('/', 1)
@@ -143,21 +368,12 @@ def image_for_type(type, size=48, flags=0):
 		except:
 			print "Error loading MIME icon"
 
-	if path:
-		if hasattr(rox.g.gdk, 'pixbuf_new_from_file_at_size'):
-			return rox.g.gdk.pixbuf_new_from_file_at_size(path,
-								      size,
-								      size)
-		else:
-			return rox.g.gdk.pixbuf_new_from_file(path)
-	else:
-		return None
+	return path
 
 class MagicRule:
+	"""A single line of a magic file. MagicType compiles these into
+	a MagicProgram; they are not used for matching directly."""
 	def __init__(self, f):
-		self.next=None
-		self.prev=None
-
 		#print line
 		ind=''
 		while True:
@@ -221,38 +437,6 @@ class MagicRule:
 	def getLength(self):
 		return self.start+self.lenvalue+self.range
 
-	def appendRule(self, rule):
-		if self.nest<rule.nest:
-			self.next=rule
-			rule.prev=self
-
-		elif self.prev:
-			self.prev.appendRule(rule)
-		
-	def match(self, buffer):
-		if self.match0(buffer):
-			if self.next:
-				return self.next.match(buffer)
-			return True
-
-	def match0(self, buffer):
-		l=len(buffer)
-		for o in range(self.range):
-			s=self.start+o
-			e=s+self.lenvalue
-			if l<e:
-				return False
-			if self.mask:
-				test=''
-				for i in range(self.lenvalue):
-					c=ord(buffer[s+i]) & ord(self.mask[i])
-					test+=chr(c)
-			else:
-				test=buffer[s:e]
-
-			if test==self.value:
-				return True
-
 	def __repr__(self):
 		return '<MagicRule %d>%d=[%d]%s&%s~%d+%d>' % (self.nest,
 							      self.start,
@@ -262,36 +446,368 @@ class MagicRule:
 							      self.word,
 							      self.range)
 
+def _masked_find(buf, start, rng, vlen, mask, value):
+	"""True if buf contains 'value' at any of the 'rng' offsets from
+	'start', after ANDing with 'mask'. mask and value are integers, so
+	each offset is tested with a single comparison."""
+	for s in xrange(start, min(start+rng, len(buf)-vlen+1)):
+		if int(hexlify(buf[s:s+vlen]), 16) & mask==value:
+			return True
+	return False
+
+class MagicProgram:
+	"""A tree of magic rules compiled into flat tables. Rule i tests
+	values[i] at offsets starts[i] to starts[i]+ranges[i]-1, optionally
+	masked with masks[i] (when it is not None, values[i] is then an
+	integer). skips[i] is the index just past rule i's children; it is
+	where matching continues if rule i fails, and equals i+1 when rule i
+	has no children."""
+	def __init__(self):
+		self.starts=array('L')
+		self.ranges=array('L')
+		self.lengths=array('L')
+		self.skips=array('L')
+		self.values=[]
+		self.masks=[]
+		self._open=[]		# (nest, index) of rules which may get children
+
+	def add(self, nest, start, value, mask=None, range=1):
+		"""Append a rule. Rules must be added in file order; 'nest' is
+		the indentation level."""
+		n=len(self.starts)
+		while self._open and self._open[-1][0]>=nest:
+			self.skips[self._open.pop()[1]]=n
+		self._open.append((nest, n))
+
+		self.starts.append(start)
+		self.ranges.append(range)
+		self.lengths.append(len(value))
+		self.skips.append(n+1)
+		if mask:
+			mask=int(hexlify(mask), 16)
+			self.masks.append(mask)
+			self.values.append(int(hexlify(value), 16) & mask)
+		else:
+			self.masks.append(None)
+			self.values.append(value)
+
+	def finish(self):
+		"""Call after the last rule has been added."""
+		n=len(self.starts)
+		for nest, i in self._open:
+			self.skips[i]=n
+		self._open=[]
+
+	def top_rules(self):
+		"""Yields (start, range, value, mask) for each top-level rule."""
+		i=0
+		n=len(self.starts)
+		while i<n:
+			yield self.starts[i], self.ranges[i], self.values[i], \
+			      self.masks[i]
+			i=self.skips[i]
+
+	def match(self, buf):
+		"""True if any top-level rule matches, along with one of its
+		children (and so on)."""
+		starts=self.starts
+		ranges=self.ranges
+		lengths=self.lengths
+		skips=self.skips
+		values=self.values
+		masks=self.masks
+		n=len(starts)
+		i=0
+		while i<n:
+			s=starts[i]
+			vlen=lengths[i]
+			mask=masks[i]
+			if mask is None:
+				ok=buf.find(values[i], s, s+ranges[i]+vlen-1)>=0
+			else:
+				ok=_masked_find(buf, s, ranges[i], vlen, mask,
+						values[i])
+			if not ok:
+				i=skips[i]
+			elif skips[i]==i+1:
+				return True
+			else:
+				i+=1
+		return False
+
+	def match_counted(self, buf):
+		"""Like match(), but returns (matched, rules, bytes), where rules
+		is the number of rules tested and bytes the number of bytes of
+		buf they were compared with. Slower; used for statistics."""
+		rules=0
+		nbytes=0
+		buflen=len(buf)
+		n=len(self.starts)
+		i=0
+		while i<n:
+			s=self.starts[i]
+			rng=self.ranges[i]
+			vlen=self.lengths[i]
+			mask=self.masks[i]
+			rules+=1
+			if mask is None:
+				ok=buf.find(self.values[i], s, s+rng+vlen-1)>=0
+				nbytes+=max(0, min(s+rng+vlen-1, buflen)-s)
+			else:
+				ok=_masked_find(buf, s, rng, vlen, mask,
+						self.values[i])
+				nbytes+=max(0, min(rng, buflen-vlen+1-s))*vlen
+			if not ok:
+				i=self.skips[i]
+			elif self.skips[i]==i+1:
+				return True, rules, nbytes
+			else:
+				i+=1
+		return False, rules, nbytes
+
+def _rules_exclusive(a, b):
+	"""True if no buffer can match one of the top-level rules in 'a' and
+	also one of those in 'b' (as given by MagicProgram.top_rules()). Only
+	unmasked rules at fixed offsets which disagree about some byte are
+	known to be exclusive."""
+	for s1, r1, v1, m1 in a:
+		for s2, r2, v2, m2 in b:
+			if m1 is not None or m2 is not None or r1!=1 or r2!=1:
+				return False
+			lo=max(s1, s2)
+			hi=min(s1+len(v1), s2+len(v2))
+			if lo>=hi or v1[lo-s1:hi-s1]==v2[lo-s2:hi-s2]:
+				return False
+	return True
+
+class MagicIndex:
+	"""A prefilter for magic matching. Entries are added with the
+	top-level rules that could make them match, and candidates() finds
+	all the entries that might match a buffer in one pass over a few
+	tables, so that only those need to be tested fully.
+
+	Rules testing a value at a fixed offset are keyed by (offset, first
+	few bytes of the value), ranged rules are tested with a single find
+	for each distinct (value, range), and entries with masked top-level
+	rules are always candidates."""
+	prefix=4
+
+	def __init__(self):
+		self._fixed={}		# (start, length) -> {prefix: [ids]}
+		self._ranged={}		# (value, start, end) -> [ids]
+		self._always=[]
+
+	def add(self, id, rules):
+		"""Add entry 'id' (an integer giving its position in the
+		matching order), which can only match if one of 'rules' does.
+		rules is a list of (start, range, value, mask) tuples."""
+		rules=list(rules)
+		for start, rng, value, mask in rules:
+			if mask is not None or not value:
+				self._always.append(id)
+				return
+		for start, rng, value, mask in rules:
+			if rng==1:
+				k=min(len(value), self.prefix)
+				table=self._fixed.setdefault((start, k), {})
+				table.setdefault(value[:k], []).append(id)
+			else:
+				key=(value, start, start+rng+len(value)-1)
+				self._ranged.setdefault(key, []).append(id)
+
+	def candidates(self, buf):
+		"""Return the sorted ids of the entries which might match buf."""
+		found=set(self._always)
+		for (start, k), table in self._fixed.iteritems():
+			ids=table.get(buf[start:start+k])
+			if ids:
+				found.update(ids)
+		for (value, start, end), ids in self._ranged.iteritems():
+			if buf.find(value, start, end)>=0:
+				found.update(ids)
+		return sorted(found)
+
 class MagicType:
 	def __init__(self, mtype):
 		self.mtype=mtype
-		self.top_rules=[]
-		self.last_rule=None
+		self.program=MagicProgram()
 
 	def getLine(self, f):
 		nrule=MagicRule(f)
-
-		if nrule.nest and self.last_rule:
-			self.last_rule.appendRule(nrule)
-		else:
-			self.top_rules.append(nrule)
-
-		self.last_rule=nrule
-
+		self.program.add(nrule.nest, nrule.start, nrule.value,
+				 nrule.mask, nrule.range)
 		return nrule
 
+	def finish(self):
+		self.program.finish()
+
 	def match(self, buffer):
-		for rule in self.top_rules:
-			if rule.match(buffer):
-				return self.mtype
+		if self.program.match(buffer):
+			return self.mtype
 
 	def __repr__(self):
 		return '<MagicType %s>' % self.mtype
 	
-class MagicDB:
+class _MagicStats:
+	"""Statistics and hit-rate ordering for a set of magic rules, shared
+	by MagicDB and MIMECache. Entries are numbered in matching order
+	(highest priority first); subclasses provide _entry(i), giving the
+	(priority, type name) of entry i, _entry_rules(i), its top-level
+	rules as for _rules_exclusive(), _test_counted(i, buf), like
+	MagicProgram.match_counted(), and _candidates(buf), the entries
+	which might match buf, in order."""
+	def __init__(self):
+		self._stats=None	# Counters, if enabled by set_stats()
+		self._reorder_interval=None
+		self._rank=None		# Testing order within each priority
+		self._exclusive={}	# (i, j) -> _rules_exclusive() result
+
+	def _reset_rank(self, n):
+		"""Called when the n entries have been (re)numbered."""
+		self._rank=range(n)
+		self._exclusive={}
+		if self._reorder_interval:
+			self._rerank()
+
+	def set_stats(self, enabled=True, reorder_interval=None):
+		"""Start (or stop) counting the work done matching and how
+		often each type matches; see get_stats(). If reorder_interval is
+		given, the types within each priority are reordered after every
+		reorder_interval matches so that the most common ones are tested
+		first. This never changes the results: when a type matches, any
+		type before it in the file with the same priority which could
+		also match is tested too, and wins if it does."""
+		self._reorder_interval=enabled and reorder_interval or None
+		if not enabled:
+			self._stats=None
+		elif self._stats is None:
+			self._stats={'calls': 0, 'types_tested': 0,
+				     'rules_tested': 0, 'bytes_compared': 0,
+				     'reorders': 0, 'hits': {}}
+		if self._rank is not None:
+			self._reset_rank(len(self._rank))
+
+	def get_stats(self):
+		"""Return a dictionary of counters, or None if they are not
+		enabled: 'calls' (matches attempted), 'types_tested',
+		'rules_tested', 'bytes_compared', 'reorders' and 'hits', a
+		dictionary giving the number of matches for each type name."""
+		if self._stats is None:
+			return None
+		stats=self._stats.copy()
+		stats['hits']=stats['hits'].copy()
+		return stats
+
+	def reorder(self):
+		"""Sort the types within each priority by their number of hits,
+		most first, keeping the file order for equal counts."""
+		if self._index is None:
+			self._build_index()
+		self._rerank()
+		if self._stats is not None:
+			self._stats['reorders']+=1
+
+	def _rerank(self):
+		hits=self._stats and self._stats['hits'] or {}
+		entry=self._entry
+		ids=range(len(self._rank))
+		keys={}
+		for i in ids:
+			pri, name=entry(i)
+			keys[i]=(-pri, -hits.get(name, 0), i)
+		ids.sort(key=keys.__getitem__)
+		for rank, i in enumerate(ids):
+			self._rank[i]=rank
+
+	def _is_exclusive(self, i, j):
+		key=(i, j)
+		try:
+			return self._exclusive[key]
+		except KeyError:
+			x=_rules_exclusive(list(self._entry_rules(i)),
+					   list(self._entry_rules(j)))
+			self._exclusive[key]=x
+			return x
+
+	def _test(self, i, buf):
+		stats=self._stats
+		ok, rules, nbytes=self._test_counted(i, buf)
+		stats['types_tested']+=1
+		stats['rules_tested']+=rules
+		stats['bytes_compared']+=nbytes
+		return ok
+
+	def _match_counted(self, buf, max_pri, min_pri):
+		"""Matching with statistics, trying each priority's types
+		in rank order. Returns a (priority, type_name) pair or None."""
+		stats=self._stats
+		stats['calls']+=1
+		if self._reorder_interval and \
+		   stats['calls']%self._reorder_interval==0:
+			self.reorder()
+		entry=self._entry
+		rank=self._rank
+		cands=[(i, entry(i)) for i in self._candidates(buf)]
+		cands=[(i, e) for i, e in cands if min_pri<=e[0]<=max_pri]
+		start=0
+		while start<len(cands):
+			pri=cands[start][1][0]
+			end=start+1
+			while end<len(cands) and cands[end][1][0]==pri:
+				end+=1
+			bucket=[i for i, e in cands[start:end]]
+			failed=set()
+			for i in sorted(bucket, key=rank.__getitem__):
+				if not self._test(i, buf):
+					failed.add(i)
+					continue
+				# Keep the file order for ties
+				for j in bucket:
+					if j>=i:
+						break
+					if j not in failed and \
+					   not self._is_exclusive(i, j) and \
+					   self._test(j, buf):
+						i=j
+						break
+				name=entry(i)[1]
+				stats['hits'][name]=stats['hits'].get(name, 0)+1
+				return pri, name
+			start=end
+		return None
+
+class MagicDB(_MagicStats):
 	def __init__(self):
+		_MagicStats.__init__(self)
 		self.types={}   # Indexed by priority, each entry is a list of type rules
 		self.maxlen=0
+		self._ordered=None	# (priority, MagicType) in matching order
+		self._index=None
+
+	def _build_index(self):
+		pris=self.types.keys()
+		pris.sort(lambda a, b: -cmp(a, b))
+		self._ordered=[]
+		self._index=MagicIndex()
+		for pri in pris:
+			for type in self.types[pri]:
+				self._index.add(len(self._ordered),
+						type.program.top_rules())
+				self._ordered.append((pri, type))
+		self._reset_rank(len(self._ordered))
+
+	def _entry(self, i):
+		pri, type=self._ordered[i]
+		return pri, type.mtype
+
+	def _entry_rules(self, i):
+		return self._ordered[i][1].program.top_rules()
+
+	def _test_counted(self, i, buf):
+		return self._ordered[i][1].program.match_counted(buf)
+
+	def _candidates(self, buf):
+		return self._index.candidates(buf)
 
 	def mergeFile(self, fname):
 		f=file(fname, 'r')
@@ -299,6 +815,7 @@ class MagicDB:
 		if line!='MIME-Magic\0\n':
 			raise 'Not a MIME magic file'
 
+		self._index=None
 		while True:
 			shead=f.readline()
 			#print shead
@@ -309,7 +826,7 @@ class MagicDB:
 			pri, tname=shead[1:-2].split(':')
 			#print shead[1:-2]
 			pri=int(pri)
-			mtype=lookup(tname)
+			mtype=intern(tname)
 
 			try:
 				ents=self.types[pri]
@@ -332,6 +849,7 @@ class MagicDB:
 				c=f.read(1)
 				f.seek(-1, 1)
 
+			magictype.finish()
 			ents.append(magictype)
 			#self.types[pri]=ents
 			if not c:
@@ -340,26 +858,428 @@ class MagicDB:
 	def match(self, path, max_pri=100, min_pri=0):
 		try:
 			buf=file(path, 'r').read(self.maxlen)
-			pris=self.types.keys()
-			pris.sort(lambda a, b: -cmp(a, b))
-			for pri in pris:
-				#print pri, max_pri, min_pri
-				if pri>max_pri:
-					continue
-				if pri<min_pri:
-					break
-				for type in self.types[pri]:
-					m=type.match(buf)
-					if m:
-						return m
+			m=self.match_data(buf, max_pri, min_pri)
+			if m:
+				return lookup(m[1])
 		except:
 			pass
 		
 		return None
-	
+
+	def match_data(self, buf, max_pri=100, min_pri=0):
+		"""Match against the start of a file's contents. Returns a
+		(priority, type_name) pair for the first match, or None."""
+		if self._index is None:
+			self._build_index()
+		if self._stats is not None:
+			return self._match_counted(buf, max_pri, min_pri)
+		ordered=self._ordered
+		for i in self._index.candidates(buf):
+			pri, type=ordered[i]
+			if pri>max_pri:
+				continue
+			if pri<min_pri:
+				break
+			m=type.match(buf)
+			if m:
+				return pri, m
+		return None
+
 	def __repr__(self):
 		return '<MagicDB %s>' % self.types
-			
+
+def _translate_glob(pattern):
+	"""fnmatch.translate() without the end-of-string anchor, so that the
+	result can be combined with others."""
+	r=fnmatch.translate(pattern)
+	for suffix in ('\\Z(?ms)', '$'):
+		if r.endswith(suffix):
+			return r[:-len(suffix)]
+	return r
+
+class GlobMatcher:
+	"""Matches a leafname against many glob patterns at once. The
+	patterns are compiled into one regular expression (per hundred
+	patterns, due to the limit on groups), with the alternatives ordered
+	by weight and then length, so that a single match finds the best
+	pattern. Case-insensitive patterns are matched against the lowercase
+	name."""
+	_max_groups=99
+
+	def __init__(self):
+		self._globs=[]		# (weight, length, type, pattern, case_sensitive)
+		self._compiled=None
+
+	def add(self, pattern, mtype, weight=50, case_sensitive=False):
+		if not case_sensitive:
+			pattern=pattern.lower()
+		self._globs.append((weight, len(pattern), mtype, pattern,
+				    case_sensitive))
+		self._compiled=None
+
+	def __len__(self):
+		return len(self._globs)
+
+	def _compile(self):
+		ordered=self._globs[:]
+		# Stable, so equal patterns keep their file order
+		ordered.sort(lambda a, b: cmp((b[0], b[1]), (a[0], a[1])))
+		self._compiled=[]
+		for cs in (False, True):
+			globs=[g for g in ordered if g[4]==cs]
+			for i in range(0, len(globs), self._max_groups):
+				chunk=globs[i:i+self._max_groups]
+				regex=re.compile('(?s)(?:%s)\\Z' % '|'.join(
+					['(%s)' % _translate_glob(g[3]) for g in chunk]))
+				self._compiled.append((regex, chunk, cs))
+
+	def match(self, leaf):
+		"""Return the type of the best matching pattern, or None."""
+		if self._compiled is None:
+			self._compile()
+		lleaf=leaf.lower()
+		best=None
+		for regex, globs, cs in self._compiled:
+			if cs:
+				m=regex.match(leaf)
+			else:
+				m=regex.match(lleaf)
+			if m:
+				g=globs[m.lastindex-1]
+				if best is None or g[:2]>best[:2]:
+					best=g
+		if best:
+			return best[2]
+		return None
+
+_non_ascii=re.compile('[\x80-\xff]').search
+
+def _unpack(fmt, buf, offset):
+	return struct.unpack_from(fmt, buf, offset)
+
+class MIMECache(_MagicStats):
+	"""A binary mime.cache file, as written by update-mime-database.
+	The file is memory-mapped and all lookups are done directly on the
+	mapped buffer, so nothing is parsed up-front and the pages are
+	shared with every other process using the same cache."""
+	def __init__(self, path):
+		_MagicStats.__init__(self)
+		f=file(path, 'rb')
+		try:
+			self.buf=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+		self.path=path
+
+		major, minor=_unpack('>HH', self.buf, 0)
+		if major!=1 or minor<1:
+			raise Exception('Unsupported mime.cache version %d.%d' %
+					(major, minor))
+		(self.alias_list, self.parent_list, self.literal_list,
+		 self.suffix_tree, self.glob_list,
+		 self.magic_list)=_unpack('>6L', self.buf, 4)
+		self.maxlen=_unpack('>L', self.buf, self.magic_list+4)[0]
+		self._index=None
+		self._globs=None
+		self._nliterals=_unpack('>L', self.buf, self.literal_list)[0]
+		self._names={}		# Literal list record -> name, as probed
+		self._levels={}		# Offset -> decoded suffix tree level
+		self._roots=_unpack('>L', self.buf, self.suffix_tree+4)[0]
+
+	def _string(self, offset):
+		"""Get the nul-terminated string at offset"""
+		return self.buf[offset:self.buf.find('\0', offset)]
+
+	def _bsearch(self, list_offset, size, key):
+		"""Binary search a sorted list of records of 'size' bytes, each
+		starting with a string offset. Returns the record's offset,
+		or None."""
+		n=_unpack('>L', self.buf, list_offset)[0]
+		lo=0
+		hi=n-1
+		while lo<=hi:
+			mid=(lo+hi)//2
+			rec=list_offset+4+size*mid
+			s=self._string(_unpack('>L', self.buf, rec)[0])
+			if s<key:
+				lo=mid+1
+			elif s>key:
+				hi=mid-1
+			else:
+				return rec
+		return None
+
+	def resolve_alias(self, name):
+		"""Return the canonical name for the alias 'name', or None if
+		it is not an alias."""
+		rec=self._bsearch(self.alias_list, 8, name)
+		if rec is None:
+			return None
+		return self._string(_unpack('>L', self.buf, rec+4)[0])
+
+	def get_aliases(self):
+		"""Return a dictionary mapping every alias to its canonical name."""
+		buf=self.buf
+		aliases={}
+		n=_unpack('>L', buf, self.alias_list)[0]
+		for i in xrange(n):
+			aoff, toff=_unpack('>LL', buf, self.alias_list+4+8*i)
+			aliases[self._string(aoff)]=self._string(toff)
+		return aliases
+
+	def get_parents(self):
+		"""Return a dictionary mapping type names to lists of the names
+		of their parent types."""
+		buf=self.buf
+		parents={}
+		n=_unpack('>L', buf, self.parent_list)[0]
+		for i in xrange(n):
+			toff, poff=_unpack('>LL', buf, self.parent_list+4+8*i)
+			nparents=_unpack('>L', buf, poff)[0]
+			parents[self._string(toff)]=[self._string(off) for off in
+				_unpack('>%dL' % nparents, buf, poff+4)]
+		return parents
+
+	def _literal_name(self, rec):
+		"""Read the name in the literal list record at rec. The few names
+		a binary search probes are memoized."""
+		name=self._names[rec]=self._string(_unpack('>L', self.buf, rec)[0])
+		return name
+
+	def _lookup_literal(self, leaf, case_sensitive_check):
+		names=self._names
+		first=self.literal_list+4
+		lo=0
+		hi=self._nliterals-1
+		while lo<=hi:
+			mid=(lo+hi)//2
+			rec=first+12*mid
+			s=names.get(rec) or self._literal_name(rec)
+			if s<leaf:
+				lo=mid+1
+			elif s>leaf:
+				hi=mid-1
+			else:
+				break
+		else:
+			return None
+		# There may be several records for this name (eg, a case
+		# sensitive one and a case insensitive one), so check its
+		# neighbours too.
+		last=first+12*(self._nliterals-1)
+		while rec>first and self._literal_name(rec-12)==leaf:
+			rec-=12
+		while rec<=last and self._literal_name(rec)==leaf:
+			toff, flags=_unpack('>LL', self.buf, rec+4)
+			if case_sensitive_check or not flags & 0x100:
+				return self._string(toff)
+			rec+=12
+		return None
+
+	def _suffix_level(self, n, offset):
+		"""Decode the n suffix tree nodes at offset into a dictionary
+		mapping character codes to (nchildren, child) pairs. Leading
+		leaf entries are the parent's matches: they are returned as
+		a list of (weight, type_name) pairs, along with the case
+		insensitive ones only. Only the levels a lookup visits are
+		decoded, and each is memoized."""
+		buf=self.buf
+		matches=[]
+		insensitive=[]
+		nodes={}
+		for i in xrange(n):
+			char, a, b=_unpack('>3L', buf, offset+12*i)
+			if char==0:
+				m=(b & 0xff, intern(self._string(a)))
+				matches.append(m)
+				if not b & 0x100:
+					insensitive.append(m)
+			else:
+				nodes[char]=(a, b)
+		level=self._levels[offset]=(nodes, matches, insensitive)
+		return level
+
+	def _lookup_suffix(self, leaf):
+		"""Search the suffix tree for leaf. Returns two lists of
+		(weight, type_name) pairs for the longest suffix with a match:
+		one using only the case-insensitive patterns, and one using
+		all of them. Don't modify them."""
+		levels=self._levels
+		nodes=(levels.get(self._roots) or self._suffix_level(
+				*_unpack('>LL', self.buf, self.suffix_tree)))[0]
+		found=insensitive=[]
+		i=len(leaf)-1
+		while i>=0:
+			node=nodes.get(ord(leaf[i]))
+			if node is None:
+				break
+			level=levels.get(node[1]) or self._suffix_level(*node)
+			nodes, matches, ci=level
+			if matches:
+				found=matches
+				if ci:
+					insensitive=ci
+			i-=1
+		return insensitive, found
+
+	def _glob_matcher(self):
+		if self._globs is None:
+			buf=self.buf
+			n=_unpack('>L', buf, self.glob_list)[0]
+			self._globs=GlobMatcher()
+			for i in xrange(n):
+				goff, toff, flags=_unpack('>3L', buf,
+							  self.glob_list+4+12*i)
+				self._globs.add(self._string(goff), self._string(toff),
+						flags & 0xff, bool(flags & 0x100))
+		return self._globs
+
+	def lookup_name(self, leaf):
+		"""Return the name of the type for a file called 'leaf', or None
+		if not known. Literal names are checked first, then the suffix
+		tree, then the remaining globs."""
+		if isinstance(leaf, unicode):
+			uleaf=leaf
+			leaf=leaf.encode('utf-8')
+		elif _non_ascii(leaf):
+			try:
+				uleaf=leaf.decode('utf-8')
+			except UnicodeError:
+				uleaf=leaf.decode('latin-1')
+		else:
+			uleaf=leaf
+
+		t=self._lookup_literal(leaf, True)
+		if t: return t
+		lleaf=leaf.lower()
+		if lleaf!=leaf:
+			t=self._lookup_literal(lleaf, False)
+			if t: return t
+
+		if uleaf is leaf:
+			ulleaf=lleaf
+		else:
+			ulleaf=uleaf.lower()
+
+		found=[]
+		if ulleaf:
+			# One walk does for both when the name is in lower case
+			found, matches=self._lookup_suffix(ulleaf)
+			if len(found)<2:
+				if uleaf!=ulleaf:
+					matches=self._lookup_suffix(uleaf)[1]
+				found=found+matches
+		if not found:
+			return self._glob_matcher().match(leaf)
+		best=found[0]
+		for f in found[1:]:
+			if f[0]>best[0]:
+				best=f
+		return best[1]
+
+	def _match_matchlets(self, data, n, offset):
+		buf=self.buf
+		for i in xrange(n):
+			(start, rng, word, vlen, voff, moff, nchildren,
+			 child)=_unpack('>8L', buf, offset+32*i)
+			value=buf[voff:voff+vlen]
+			if moff:
+				mask=int(hexlify(buf[moff:moff+vlen]), 16)
+				matched=_masked_find(data, start, rng, vlen, mask,
+					int(hexlify(value), 16) & mask)
+			else:
+				matched=data.find(value, start, start+rng+vlen-1)>=0
+			if matched:
+				if not nchildren or \
+				   self._match_matchlets(data, nchildren, child):
+					return True
+		return False
+
+	def _top_matchlets(self, n, offset):
+		buf=self.buf
+		for i in xrange(n):
+			start, rng, word, vlen, voff, moff=_unpack('>6L', buf,
+							offset+32*i)
+			yield start, rng, buf[voff:voff+vlen], moff or None
+
+	def _match_matchlets_counted(self, data, n, offset, counts):
+		"""_match_matchlets(), adding the number of rules tested and
+		bytes compared to counts."""
+		buf=self.buf
+		datalen=len(data)
+		for i in xrange(n):
+			(start, rng, word, vlen, voff, moff, nchildren,
+			 child)=_unpack('>8L', buf, offset+32*i)
+			value=buf[voff:voff+vlen]
+			counts[0]+=1
+			if moff:
+				mask=int(hexlify(buf[moff:moff+vlen]), 16)
+				matched=_masked_find(data, start, rng, vlen, mask,
+					int(hexlify(value), 16) & mask)
+				counts[1]+=max(0, min(rng, datalen-vlen+1-start))*vlen
+			else:
+				matched=data.find(value, start, start+rng+vlen-1)>=0
+				counts[1]+=max(0, min(start+rng+vlen-1, datalen)-start)
+			if matched:
+				if not nchildren or \
+				   self._match_matchlets_counted(data, nchildren,
+								 child, counts):
+					return True
+		return False
+
+	def _build_index(self):
+		buf=self.buf
+		n, maxlen, first=_unpack('>3L', buf, self.magic_list)
+		self._index=MagicIndex()
+		for i in xrange(n):
+			pri, toff, nmatchlets, moff=_unpack('>4L', buf, first+16*i)
+			self._index.add(i, self._top_matchlets(nmatchlets, moff))
+		self._reset_rank(n)
+
+	def _magic_entry(self, i):
+		first=_unpack('>L', self.buf, self.magic_list+8)[0]
+		return _unpack('>4L', self.buf, first+16*i)
+
+	def _entry(self, i):
+		pri, toff, nmatchlets, moff=self._magic_entry(i)
+		return pri, self._string(toff)
+
+	def _entry_rules(self, i):
+		pri, toff, nmatchlets, moff=self._magic_entry(i)
+		return self._top_matchlets(nmatchlets, moff)
+
+	def _test_counted(self, i, data):
+		pri, toff, nmatchlets, moff=self._magic_entry(i)
+		counts=[0, 0]
+		ok=self._match_matchlets_counted(data, nmatchlets, moff, counts)
+		return ok, counts[0], counts[1]
+
+	def _candidates(self, data):
+		return self._index.candidates(data)
+
+	def magic_match(self, data, max_pri=100, min_pri=0):
+		"""Match the magic rules against the start of a file's contents.
+		Returns a (priority, type_name) pair for the first match, or
+		None. The index of candidate matches is built on first use."""
+		buf=self.buf
+		if self._index is None:
+			self._build_index()
+		if self._stats is not None:
+			return self._match_counted(data, max_pri, min_pri)
+		n, maxlen, first=_unpack('>3L', buf, self.magic_list)
+		for i in self._index.candidates(data):
+			pri, toff, nmatchlets, moff=_unpack('>4L', buf, first+16*i)
+			if pri>max_pri:
+				continue
+			if pri<min_pri:
+				break
+			if self._match_matchlets(data, nmatchlets, moff):
+				return pri, self._string(toff)
+		return None
+
+	def __repr__(self):
+		return '<MIMECache %s>' % self.path
+
 
 # Some well-known types
 text = lookup('text', 'plain')
@@ -372,17 +1292,114 @@ inode_symlink = lookup('inode', 'symlink')
 inode_door = lookup('inode', 'door')
 app_exe = lookup('application', 'executable')
 
-_cache_uptodate = False
+_cache_uptodate = False	# False if the database must be reloaded
+_globs_loaded = False	# exts, globs, literals, etc are loaded
+_magic_loaded = False	# magic is loaded
+_text_dirs = []		# MIME directories without an up-to-date mime.cache
+_type_cache = None	# LRUCache of get_type() results, if enabled
+_db_stamp = None	# _database_stamp() when the database was loaded
+_reload_interval = None	# Seconds between checks for changes, if enabled
+_reload_background = False
+_reload_checked = 0	# time.time() of the last check
+_reload_task = None	# Task doing a background reload
+_magic_stats = False	# Collect MagicDB statistics
+_xattr_write = False	# Store types found in extended attributes
+_xattr_unsupported = set()	# Devices on which storing them failed
+_xattr_denied = None	# LRUCache of (dev, ino) -> ctime, where not allowed
+_magic_reorder_interval = None
+
+def _load_cache(mime_dir):
+	"""Return a MIMECache for mime_dir's mime.cache, or None if there
+	isn't one or it is older than the text files it was built from."""
+	path = os.path.join(mime_dir, 'mime.cache')
+	try:
+		mtime = os.stat(path).st_mtime
+	except OSError:
+		return None
+	for leaf in ('globs', 'globs2', 'magic'):
+		try:
+			if os.stat(os.path.join(mime_dir, leaf)).st_mtime > mtime:
+				return None
+		except OSError:
+			pass
+	try:
+		cache = MIMECache(path)
+	except:
+		return None
+	if _magic_stats:
+		cache.set_stats(True, _magic_reorder_interval)
+	return cache
+
+def _database_stamp():
+	"""Modification times of the files in every MIME directory (whether
+	or not they exist yet), used to spot changes to the database."""
+	stamp = []
+	for data_dir in basedir.xdg_data_dirs:
+		mime_dir = os.path.join(data_dir, 'mime')
+		for leaf in ('mime.cache', 'globs', 'globs2', 'magic'):
+			try:
+				stamp.append(os.stat(os.path.join(mime_dir, leaf)).st_mtime)
+			except OSError:
+				stamp.append(None)
+	return stamp
+
+def _find_caches():
+	"""Returns a list of MIMECaches and a list of the MIME directories
+	which have no up-to-date cache."""
+	caches = []
+	text_dirs = []
+	for mime_dir in basedir.load_data_paths('mime'):
+		cache = _load_cache(mime_dir)
+		if cache:
+			caches.append(cache)
+		else:
+			text_dirs.append(mime_dir)
+	return caches, text_dirs
 
 def _cache_database():
-	global exts, globs, literals, magic, _cache_uptodate
+	"""Find the MIME directories and map their caches. The text files
+	for directories without a cache are only parsed when first needed,
+	by _load_globs() and _load_magic()."""
+	global caches, _text_dirs, _cache_uptodate, _globs_loaded, _magic_loaded
+	global _db_stamp, _comments, _hierarchy
 
 	_cache_uptodate = True
-
-	exts = {}		# Maps extensions to types
-	globs = []		# List of (glob, type) pairs
-	literals = {}		# Maps liternal names to types
-	magic = MagicDB()
+	if _type_cache is not None:
+		_type_cache.clear()
+	_comments = None
+	_hierarchy = None
+
+	_db_stamp = _database_stamp()
+	caches, _text_dirs = _find_caches()
+	_globs_loaded = False
+	_magic_loaded = False
+
+def _read_globs(text_dirs):
+	"""Read the name matching tables from the text files. The tables hold
+	type names; MIMEtype objects are only created for results. Returns
+	(exts, globs, literals, case_exts, case_literals)."""
+	exts = {}
+	globs = GlobMatcher()
+	literals = {}
+	case_exts = {}
+	case_literals = {}
+
+	def _add_pattern(pattern, type_name, weight, case_sensitive):
+		type_name = intern(type_name)
+		if '*' in pattern or '[' in pattern or '?' in pattern:
+			rest = pattern[2:]
+			if pattern.startswith('*.') and not \
+			   ('*' in rest or '[' in rest or '?' in rest):
+				if case_sensitive:
+					case_exts.setdefault(rest, type_name)
+				else:
+					exts.setdefault(rest.lower(), type_name)
+			else:
+				globs.add(pattern, type_name, weight, case_sensitive)
+		elif case_sensitive:
+			case_literals.setdefault(pattern, type_name)
+		else:
+			literals.setdefault(pattern.lower(), type_name)
 
 	def _import_glob_file(path):
 		"""Loads name matching information from a MIME directory."""
@@ -391,72 +1408,420 @@ def _cache_database():
 			line = line[:-1]
 
 			type_name, pattern = line.split(':', 1)
-			mtype = lookup(type_name)
+			_add_pattern(pattern, type_name, 50, False)
 
-			if pattern.startswith('*.'):
-				rest = pattern[2:]
-				if not ('*' in rest or '[' in rest or '?' in rest):
-					exts[rest] = mtype
-					continue
-			if '*' in pattern or '[' in pattern or '?' in pattern:
-				globs.append((pattern, mtype))
-			else:
-				literals[pattern] = mtype
+	def _import_glob2_file(path):
+		"""Loads weighted name matching information (globs2)."""
+		for line in file(path):
+			if line.startswith('#'): continue
+			fields = line[:-1].split(':')
+			weight, type_name, pattern = fields[:3]
+			case_sensitive = len(fields) > 3 and \
+					 'cs' in fields[3].split(',')
+			_add_pattern(pattern, type_name, int(weight),
+				     case_sensitive)
+
+	for mime_dir in text_dirs:
+		path = os.path.join(mime_dir, 'globs2')
+		if os.path.exists(path):
+			_import_glob2_file(path)
+		else:
+			path = os.path.join(mime_dir, 'globs')
+			if os.path.exists(path):
+				_import_glob_file(path)
+	return exts, globs, literals, case_exts, case_literals
 
-	for path in basedir.load_data_paths(os.path.join('mime', 'globs')):
-		_import_glob_file(path)
-	for path in basedir.load_data_paths(os.path.join('mime', 'magic')):
-		magic.mergeFile(path)
+def _read_magic(text_dirs):
+	"""Read the magic rules from the text files into a new MagicDB."""
+	magic = MagicDB()
+	for mime_dir in text_dirs:
+		path = os.path.join(mime_dir, 'magic')
+		if os.path.exists(path):
+			magic.mergeFile(path)
+	if _magic_stats:
+		magic.set_stats(True, _magic_reorder_interval)
+	return magic
 
-	# Sort globs by length
-	globs.sort(lambda a, b: cmp(len(b[0]), len(a[0])))
+def _load_globs():
+	global exts, globs, literals, case_exts, case_literals, _globs_loaded
 
-def get_type_by_name(path):
-	"""Returns type of file by its name, or None if not known"""
 	if not _cache_uptodate:
 		_cache_database()
+	exts, globs, literals, case_exts, case_literals = _read_globs(_text_dirs)
+	_globs_loaded = True
+
+def _load_magic():
+	global magic, _magic_loaded
+
+	if not _cache_uptodate:
+		_cache_database()
+	magic = _read_magic(_text_dirs)
+	_magic_loaded = True
+
+def _reload_in_background():
+	"""A rox.tasks generator which builds new tables for the parts of the
+	database that are in use, and then switches to them all at once.
+	Until then, lookups continue to use the old tables."""
+	global caches, _text_dirs, exts, globs, literals, case_exts, case_literals
+	global magic, _db_stamp, _reload_task, _hierarchy, _comments
+	global _globs_loaded, _magic_loaded
+
+	try:
+		stamp = _database_stamp()
+		new_caches, text_dirs = _find_caches()
+		new_globs = new_magic = None
+		yield None
+		if _globs_loaded:
+			new_globs = _read_globs(text_dirs)
+			yield None
+		if _magic_loaded:
+			new_magic = _read_magic(text_dirs)
+			yield None
+
+		# Lookups may have loaded more of the old tables meanwhile
+		if _globs_loaded and new_globs is None:
+			new_globs = _read_globs(text_dirs)
+		if _magic_loaded and new_magic is None:
+			new_magic = _read_magic(text_dirs)
+
+		if _type_cache is not None:
+			_type_cache.clear()
+		_db_stamp = stamp
+		caches, _text_dirs = new_caches, text_dirs
+		if new_globs is not None:
+			exts, globs, literals, case_exts, case_literals = new_globs
+			_globs_loaded = True
+		if new_magic is not None:
+			magic = new_magic
+			_magic_loaded = True
+		_comments = None
+		_hierarchy = None
+	finally:
+		_reload_task = None
+
+def set_auto_reload(interval=5, background=False):
+	"""Notice when the database is changed by another program (for
+	example, when an application installs new types). Lookups check the
+	modification times of the database files at most once every 'interval'
+	seconds and reload the database if they have changed. Use None to turn
+	checking off again (the default).
+
+	If background is True then the new tables are built by a rox.tasks
+	Task and lookups use the old ones until it has finished. This needs a
+	running main loop."""
+	global _reload_interval, _reload_background, _reload_checked
+	_reload_interval = interval
+	_reload_background = background
+	_reload_checked = time.time()
+
+def _check_uptodate():
+	"""Called at the start of each lookup. Reloads the database if
+	automatic reloading is on and it has changed."""
+	global _reload_checked, _reload_task, _cache_uptodate
+	if _reload_interval is None or not _cache_uptodate:
+		return
+	now = time.time()
+	if now - _reload_checked < _reload_interval:
+		return
+	_reload_checked = now
+	if _database_stamp() == _db_stamp or _reload_task:
+		return
+	if _reload_background:
+		from rox import tasks
+		_reload_task = tasks.Task(_reload_in_background(),
+					  'Reload MIME database')
+	else:
+		_cache_uptodate = False
+
+def get_type_by_name(path):
+	"""Returns type of file by its name, or None if not known"""
+	_check_uptodate()
+	if not (_cache_uptodate and _globs_loaded):
+		_load_globs()
 
 	leaf = os.path.basename(path)
-	if leaf in literals:
-		return literals[leaf]
+	for cache in caches:
+		name = cache.lookup_name(leaf)
+		if name:
+			return lookup(name)
 
 	lleaf = leaf.lower()
-	if lleaf in literals:
-		return literals[lleaf]
-
-	ext = leaf
-	while 1:
-		p = ext.find('.')
-		if p < 0: break
-		ext = ext[p + 1:]
-		if ext in exts:
-			return exts[ext]
-	ext = lleaf
-	while 1:
-		p = ext.find('.')
-		if p < 0: break
-		ext = ext[p+1:]
-		if ext in exts:
-			return exts[ext]
-	for (glob, mime_type) in globs:
-		if fnmatch.fnmatch(leaf, glob):
-			return mime_type
-		if fnmatch.fnmatch(lleaf, glob):
-			return mime_type
+	name = case_literals.get(leaf, None) or literals.get(lleaf, None)
+	if name:
+		return lookup(name)
+
+	for ext_leaf, table in ((leaf, case_exts), (lleaf, exts)):
+		ext = ext_leaf
+		while 1:
+			p = ext.find('.')
+			if p < 0: break
+			ext = ext[p + 1:]
+			if ext in table:
+				return lookup(table[ext])
+
+	name = globs.match(leaf)
+	if name:
+		return lookup(name)
+	return None
+
+def _magic_maxlen():
+	"""The number of bytes at the start of a file that magic matching
+	can look at."""
+	if not (_cache_uptodate and _magic_loaded):
+		_load_magic()
+	maxlen = magic.maxlen
+	for cache in caches:
+		maxlen = max(maxlen, cache.maxlen)
+	return maxlen
+
+def _read_header(path):
+	"""Read as much of the start of a file as magic matching needs.
+	Returns None if the file can't be read."""
+	maxlen = _magic_maxlen()
+	try:
+		fd = os.open(path, os.O_RDONLY)
+	except OSError:
+		return None
+	try:
+		try:
+			return os.read(fd, maxlen)
+		except OSError:
+			return None
+	finally:
+		os.close(fd)
+
+def _match_contents(buf, max_pri=100, min_pri=0):
+	"""Take the highest priority match for buf from all the databases."""
+	if not (_cache_uptodate and _magic_loaded):
+		_load_magic()
+	best = magic.match_data(buf, max_pri, min_pri)
+	for cache in caches:
+		m = cache.magic_match(buf, max_pri, min_pri)
+		if m and (not best or m[0] > best[0]):
+			best = m
+	if best:
+		return lookup(best[1])
 	return None
 
 def get_type_by_contents(path, max_pri=100, min_pri=0):
 	"""Returns type of file by its contents, or None if not known"""
+	_check_uptodate()
+	if not _cache_uptodate:
+		_cache_database()
+
+	buf = _read_header(path)
+	if buf is None:
+		return None
+	return _match_contents(buf, max_pri, min_pri)
+
+def get_type_by_data(data, name=None, name_pri=100):
+	"""Returns type of some data held in memory (eg, dropped on a window),
+	or None if not known. 'data' may be a string, buffer, memoryview or
+	mmap; only the start of it is looked at. If 'name' is given, it is
+	used as with get_type(): magic rules with a priority of at least
+	'name_pri' are tried first, then the name, then the other rules."""
+	_check_uptodate()
+	if not _cache_uptodate:
+		_cache_database()
+
+	buf = data[:_magic_maxlen()]
+	if hasattr(buf, 'tobytes'):
+		buf = buf.tobytes()	# memoryview (Python 2.7)
+	elif not isinstance(buf, str):
+		buf = str(buf)
+	if name is None:
+		return _match_contents(buf)
+	t = _match_contents(buf, min_pri=name_pri)
+	if not t: t = get_type_by_name(name)
+	if not t: t = _match_contents(buf, max_pri=name_pri)
+	return t
+
+def get_type_by_stream(stream, name=None, name_pri=100):
+	"""Returns type of the data read from stream, or None if not known.
+	Only as many bytes as the magic rules need are read, so the stream
+	is left part way through. 'name' is used as for get_type_by_data()."""
+	_check_uptodate()
 	if not _cache_uptodate:
 		_cache_database()
 
-	return magic.match(path, max_pri, min_pri)
+	return get_type_by_data(stream.read(_magic_maxlen()), name, name_pri)
+
+def _get_type_for_stat(path, st, name_pri):
+	"""Type of path, which has already been stat'ed. The file's header
+	is read at most once, and shared by both magic passes."""
+	return _get_type_and_stat(path, st, name_pri)[0]
+
+def _get_type_and_stat(path, st, name_pri):
+	"""Like _get_type_for_stat(), but returns (type, st). If the type was
+	stored in the file's extended attributes (changing its ctime), st is
+	the file's new stat result."""
+	try:
+		if xattr.present(path):
+			name = xattr.get(path, xattr.USER_MIME_TYPE)
+			if name and '/' in name:
+				# Types we stored ourselves are only used while
+				# the file is unchanged
+				stamp = xattr.get(path, xattr.ROX_MIME_TYPE_STAMP)
+				if stamp is None or \
+				   stamp == _xattr_stamp(path, st):
+					media, subtype=resolve_alias(name).split('/')
+					return lookup(media, subtype), st
+	except:
+		pass
+
+	if stat.S_ISREG(st.st_mode):
+		buf = _read_header(path)
+		t = None
+		sniffed = False
+		if buf is not None:
+			t = _match_contents(buf, min_pri=name_pri)
+			sniffed = t is not None
+		if not t: t = get_type_by_name(path)
+		if not t and buf is not None:
+			t = _match_contents(buf, max_pri=name_pri)
+			sniffed = t is not None
+		# Only store types found by reading the file; the name is
+		# quick to check again, and may change
+		if sniffed and _xattr_write and name_pri == 100:
+			st = _store_type(path, st, t)
+		if t is None:
+			if stat.S_IMODE(st.st_mode) & 0111:
+				t = app_exe
+			else:
+				t = text
+	elif stat.S_ISDIR(st.st_mode): t = inode_dir
+	elif stat.S_ISCHR(st.st_mode): t = inode_char
+	elif stat.S_ISBLK(st.st_mode): t = inode_block
+	elif stat.S_ISFIFO(st.st_mode): t = inode_fifo
+	elif stat.S_ISLNK(st.st_mode): t = inode_symlink
+	elif stat.S_ISSOCK(st.st_mode): t = inode_socket
+	else: t = inode_door
+	return t, st
+
+def set_xattr_write(enabled=True):
+	"""Store the types found by get_type() in the files' extended
+	attributes (xattr.USER_MIME_TYPE), so that later lookups, by any
+	program, can use them without reading the files. Only types found
+	by reading the file (with the default name_pri) are stored. They are
+	stamped with the file's name, size and modification time, and
+	rox.mime ignores them once the file is renamed or changed. Nothing
+	is stored through a symlink, or on a file with several hard links.
+	Types set by the user (with no stamp) are always used."""
+	global _xattr_write
+	_xattr_write = enabled
+
+def _xattr_stamp(path, st):
+	return '%d %r %s' % (st.st_size, st.st_mtime, os.path.basename(path))
+
+def _store_type(path, st, t):
+	"""Save path's type, if possible. Returns the file's stat result,
+	which is a new one if the type was stored."""
+	global _xattr_denied
+	if st.st_dev in _xattr_unsupported:
+		return st
+	if st.st_nlink > 1 or os.path.islink(path):
+		# The stamp can only name one of the file's names, and
+		# would never match when reached through the others
+		return st
+	key = (st.st_dev, st.st_ino)
+	if _xattr_denied is not None and \
+	   _xattr_denied.get(key) == st.st_ctime:
+		return st	# Not allowed, and permissions haven't changed
+	try:
+		if not xattr.supported(path):
+			return st
+		xattr.set(path, xattr.ROX_MIME_TYPE_STAMP, _xattr_stamp(path, st))
+		xattr.set(path, xattr.USER_MIME_TYPE, str(t))
+		return os.stat(path)
+	except OSError, ex:
+		if ex.errno in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EROFS):
+			_xattr_unsupported.add(st.st_dev)
+		elif ex.errno in (errno.EACCES, errno.EPERM):
+			if _xattr_denied is None:
+				from rox.lru import LRUCache
+				_xattr_denied = LRUCache(1024)
+			_xattr_denied[key] = st.st_ctime
+		return st
+
+def set_type_cache(capacity):
+	"""Remember the results of up to 'capacity' get_type() calls (and
+	so of rox.get_icon() and thumbnail.get_method(), which use it). Each
+	result is only reused while the file's device, inode, size and
+	modification and change times are unchanged. Use 0 to disable the
+	cache again (the default)."""
+	global _type_cache
+	if capacity:
+		from rox.lru import LRUCache
+		_type_cache = LRUCache(capacity)
+	else:
+		_type_cache = None
+
+def get_type_cache_stats():
+	"""Return a dictionary with the 'hits', 'misses', 'size' and
+	'capacity' of the get_type() cache, or None if it is disabled."""
+	if _type_cache is None:
+		return None
+	return _type_cache.stats()
+
+def set_magic_stats(enabled=True, reorder_interval=1000):
+	"""Count the work done matching the magic rules (from mime.cache files
+	and the text files), and the number of matches for each type (see
+	get_magic_stats()). If reorder_interval is not None, also reorder the
+	rules after every reorder_interval matches so that the most common
+	types are tried first within each priority. The results are unchanged.
+	The counters are reset when the database is reloaded."""
+	global _magic_stats, _magic_reorder_interval
+	_magic_stats = enabled
+	_magic_reorder_interval = reorder_interval
+	if _magic_loaded:
+		magic.set_stats(enabled, reorder_interval)
+	for cache in caches:
+		cache.set_stats(enabled, reorder_interval)
+
+def get_magic_stats():
+	"""Return a dictionary of counters from the magic matching, totalled
+	over all the databases ('calls', 'types_tested', 'rules_tested',
+	'bytes_compared', 'reorders' and 'hits', which maps type names to
+	match counts), or None if set_magic_stats() hasn't been used."""
+	if not _magic_stats:
+		return None
+	dbs = list(caches)
+	if _magic_loaded:
+		dbs.append(magic)
+	total = {'calls': 0, 'types_tested': 0, 'rules_tested': 0,
+		 'bytes_compared': 0, 'reorders': 0, 'hits': {}}
+	for db in dbs:
+		stats = db.get_stats()
+		if stats is None:
+			continue
+		for key, value in stats.iteritems():
+			if key == 'hits':
+				for name, n in value.iteritems():
+					total['hits'][name] = \
+						total['hits'].get(name, 0) + n
+			else:
+				total[key] += value
+	return total
+
+def _get_type_cached(path, st, follow, name_pri):
+	if _type_cache is None:
+		return _get_type_for_stat(path, st, name_pri)
+	key = (path, follow, name_pri)
+	stamp = (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+	entry = _type_cache.get(key, valid = lambda entry: entry[0] == stamp)
+	if entry:
+		return entry[1]
+	t, st = _get_type_and_stat(path, st, name_pri)
+	stamp = (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+	_type_cache[key] = (stamp, t)
+	return t
 
 def get_type(path, follow=1, name_pri=100):
 	"""Returns type of file indicated by path.
 	path	 - pathname to check (need not exist)
 	follow   - when reading file, follow symbolic links
 	name_pri - Priority to do name matches.  100=override magic"""
+	_check_uptodate()
 	if not _cache_uptodate:
 		_cache_database()
 	
@@ -469,32 +1834,132 @@ def get_type(path, follow=1, name_pri=100):
 		t = get_type_by_name(path)
 		return t or text
 
-	try:
-		if xattr.present(path):
-			name = xattr.get(path, xattr.USER_MIME_TYPE)
-			if name and '/' in name:
-				media, subtype=name.split('/')
-				return lookup(media, subtype)
-	except:
-		pass
+	return _get_type_cached(path, st, follow, name_pri)
 
-	if stat.S_ISREG(st.st_mode):
-		t = get_type_by_contents(path, min_pri=name_pri)
-		if not t: t = get_type_by_name(path)
-		if not t: t = get_type_by_contents(path, max_pri=name_pri)
-		if t is None:
-			if stat.S_IMODE(st.st_mode) & 0111:
-				return app_exe
+def get_types(paths, follow=1, name_pri=100):
+	"""Like get_type(), but for a sequence of paths. Returns a generator
+	giving a (path, type) pair for each path, in order, so that results
+	can be used as they arrive."""
+	_check_uptodate()
+	if not _cache_uptodate:
+		_cache_database()
+
+	if follow:
+		do_stat = os.stat
+	else:
+		do_stat = os.lstat
+	for path in paths:
+		try:
+			st = do_stat(path)
+		except OSError:
+			yield path, get_type_by_name(path) or text
+			continue
+		yield path, _get_type_cached(path, st, follow, name_pri)
+
+def scan_directory(dir, follow=1, name_pri=100):
+	"""Find the type of every file in a directory. Returns a generator
+	giving a (leaf, type) pair for each entry. The directory is listed
+	once and each file is stat'ed and read at most once."""
+	for path, mime_type in get_types([os.path.join(dir, leaf)
+				for leaf in os.listdir(dir)], follow, name_pri):
+		yield os.path.basename(path), mime_type
+
+def _pool_init():
+	if not _cache_uptodate:
+		_cache_database()
+
+def _pool_classify(args):
+	"""Worker process side of get_types_parallel()."""
+	paths, follow, name_pri = args
+	try:
+		return [(path, str(t)) for path, t in
+				get_types(paths, follow, name_pri)]
+	except Exception, ex:
+		return ex
+
+def _chunks(iterable, size):
+	chunk = []
+	for x in iterable:
+		chunk.append(x)
+		if len(chunk) >= size:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+def get_types_parallel(paths, processes=None, ordered=True, chunksize=64,
+		       follow=1, name_pri=100):
+	"""Like get_types(), but shares the work between a pool of worker
+	processes (using the multiprocessing module), each with its own copy
+	of the database. Use this for classifying very large numbers of files;
+	for a single directory listing get_types() is faster.
+	processes - number of workers (default is the number of CPUs)
+	ordered   - if False, results are returned as soon as they are ready
+		    rather than in the order of paths
+	chunksize - number of paths sent to a worker at a time
+	paths may be any iterable (eg, a generator walking a directory tree);
+	it is consumed only as fast as the results are, with at most two
+	chunks per worker outstanding at any time."""
+	import multiprocessing, Queue
+	from collections import deque
+
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	max_pending = 2 * processes
+
+	pool = multiprocessing.Pool(processes, _pool_init)
+	if ordered:
+		pending = deque()	# AsyncResults, in submission order
+		callback = None
+	else:
+		done = Queue.Queue()	# Results, in completion order
+		callback = done.put
+	outstanding = 0
+	finished = False
+	try:
+		chunks = _chunks(paths, chunksize)
+		while True:
+			while outstanding < max_pending:
+				try:
+					chunk = chunks.next()
+				except StopIteration:
+					break
+				r = pool.apply_async(_pool_classify,
+					((chunk, follow, name_pri),),
+					callback = callback)
+				if ordered:
+					pending.append(r)
+				outstanding += 1
+			if not outstanding:
+				break
+			if ordered:
+				results = pending.popleft().get()
 			else:
-				return text
-		return t
-	elif stat.S_ISDIR(st.st_mode): return inode_dir
-	elif stat.S_ISCHR(st.st_mode): return inode_char
-	elif stat.S_ISBLK(st.st_mode): return inode_block
-	elif stat.S_ISFIFO(st.st_mode): return inode_fifo
-	elif stat.S_ISLNK(st.st_mode): return inode_symlink
-	elif stat.S_ISSOCK(st.st_mode): return inode_socket
-	return inode_door
+				results = done.get()
+			outstanding -= 1
+			if isinstance(results, Exception):
+				raise results
+			for path, name in results:
+				yield path, lookup(name)
+		finished = True
+	finally:
+		if finished:
+			pool.close()
+		else:
+			pool.terminate()
+		pool.join()
+
+def walk_types(top, processes=None, ordered=True, chunksize=64,
+	       follow=1, name_pri=100):
+	"""Classify every file under the directory 'top' in parallel, using
+	get_types_parallel(). Returns a generator of (path, type) pairs.
+	Directories themselves are not included."""
+	def walk():
+		for dirpath, dirnames, filenames in os.walk(top):
+			for leaf in filenames:
+				yield os.path.join(dirpath, leaf)
+	return get_types_parallel(walk(), processes, ordered, chunksize,
+				  follow, name_pri)
 
 def install_mime_info(application, package_file = None):
 	"""Copy 'package_file' as ~/.local/share/mime/packages/<application>.xml.
@@ -546,14 +2011,18 @@ def install_mime_info(application, package_file = None):
 def get_type_handler(mime_type, handler_type = 'MIME-types'):
 	"""Lookup the ROX-defined run action for a given mime type.
 	mime_type is an object returned by lookup().
-	handler_type is a config directory leaf (e.g.'MIME-types')."""
-	handler = basedir.load_first_config('rox.sourceforge.net', handler_type,
-				 mime_type.media + '_' + mime_type.subtype)
-	if not handler:
-		# Fall back to the base handler if no subtype handler exists
-		handler = basedir.load_first_config('rox.sourceforge.net', handler_type,
+	handler_type is a config directory leaf (e.g.'MIME-types').
+	If there is no handler for the type itself, the handlers for the
+	types it is a subclass of are tried, nearest first, and then the
+	handler for its media type."""
+	for t in [mime_type] + mime_type.get_ancestors():
+		handler = basedir.load_first_config('rox.sourceforge.net',
+				handler_type, t.media + '_' + t.subtype)
+		if handler:
+			return handler
+	# Fall back to the base handler if no subtype handler exists
+	return basedir.load_first_config('rox.sourceforge.net', handler_type,
 					 mime_type.media)
-	return handler
 
 def _test(name):
 	"""Print results for name.  Test routine"""
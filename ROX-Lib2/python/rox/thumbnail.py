@@ -5,9 +5,12 @@ image for a type of file.
 The thumbnail standard is at http://jens.triq.net/thumbnail-spec/index.html
 """
 
-import os, sys, errno
+import os, sys, errno, time
 import tempfile
 import shutil
+import heapq
+import struct
+import zlib
 
 try:
     import hashlib
@@ -20,11 +23,158 @@ except ImportError:
         return md5.new(s).hexdigest()
 
 import rox, rox.basedir, rox.mime
+from rox import tasks, processes
+from rox.lru import LRUCache
+
+# Thumbnail leafnames, by absolute path, to save hashing the URIs again
+_leaves=LRUCache(4096)
+
+# Loaded thumbnails, by absolute path of the source file. Each entry is
+# (thumbnail path, stamp of the thumbnail file, Thumb::Size, Thumb::MTime,
+# pixbuf). The pixbuf is only used while both stamps are still right.
+_index=LRUCache(256)
+
+# Files for which thumbnail generation failed, by absolute path. The values
+# are the _stamp()s of the files when it failed; a file is tried again
+# once it changes.
+_failed=LRUCache(4096)
+
+_fail_dirs=None         # (mtime of ~/.thumbnails/fail, [subdirectories])
+
+# The subdirectories of ~/.thumbnails/fail whose markers has_failed() trusts:
+# those of our own Thumbnailers, and any added with trust_fail_markers()
+_fail_names=set(['pixbuf'])
+
+# The sizes of the 'normal' and 'large' thumbnails in the spec
+NORMAL=128
+LARGE=256
 
 def _leaf(fname):
     path=os.path.abspath(fname)
-    uri='file://'+rox.escape(path)
-    return md5hash(uri)+'.png'
+    leaf=_leaves.get(path)
+    if leaf is None:
+        uri='file://'+rox.escape(path)
+        leaf=md5hash(uri)+'.png'
+        _leaves[path]=leaf
+    return leaf
+
+def _stamp(st):
+    return (st.st_size, st.st_mtime)
+
+def _forget(fname):
+    """Drop any loaded thumbnail for fname from the index."""
+    try:
+        del _index[os.path.abspath(fname)]
+    except KeyError:
+        pass
+
+def read_png_text(path):
+    """Return a dictionary of the textual information (tEXt and zTXt
+    chunks) stored in the PNG file 'path' before the image data, without
+    decoding the image. The thumbnail spec's keys are like 'Thumb::MTime'.
+    Returns None if path can't be read or isn't a PNG file."""
+    try:
+        f=file(path, 'rb')
+    except IOError:
+        return None
+    try:
+        if f.read(8)!='\x89PNG\r\n\x1a\n':
+            return None
+        text={}
+        while True:
+            head=f.read(8)
+            if len(head)<8:
+                break
+            length, ctype=struct.unpack('>L4s', head)
+            if ctype in ('IDAT', 'IEND'):
+                break
+            if ctype in ('tEXt', 'zTXt'):
+                data=f.read(length)
+                f.seek(4, 1)        # CRC
+                if '\0' not in data:
+                    continue
+                key, value=data.split('\0', 1)
+                if ctype=='zTXt':
+                    try:
+                        value=zlib.decompress(value[1:])
+                    except zlib.error:
+                        continue
+                text[key]=value
+            else:
+                f.seek(length+4, 1)
+        return text
+    finally:
+        f.close()
+
+def _is_valid(text, st):
+    """True if the PNG text from a thumbnail says it is for a file with
+    stat results st."""
+    try:
+        tsize=int(text['Thumb::Size'])
+        tmtime=float(text['Thumb::MTime'])
+    except (KeyError, ValueError, TypeError):
+        return False
+    return tsize==int(st.st_size) and int(tmtime)==int(st.st_mtime)
+
+def _get_fail_dirs():
+    """List the directories holding fail markers (one for each program
+    which writes them). The list is only reread when it changes."""
+    global _fail_dirs
+    fail=os.path.join(os.environ['HOME'], '.thumbnails', 'fail')
+    try:
+        mtime=os.stat(fail).st_mtime
+    except OSError:
+        return []
+    if _fail_dirs is None or _fail_dirs[0]!=mtime:
+        dirs=[os.path.join(fail, d) for d in os.listdir(fail)]
+        _fail_dirs=(mtime, [d for d in dirs if os.path.isdir(d)])
+    return _fail_dirs[1]
+
+def trust_fail_markers(name):
+    """Let has_failed() use the fail markers written by another program,
+    in ~/.thumbnails/fail/name. Only those written by Thumbnailers are
+    used otherwise, since another program's failure says little about
+    whether ours will work."""
+    _fail_names.add(name)
+
+def get_fail_path(fname):
+    """Given a file name return the full path of a marker saying that
+    making its thumbnail failed (written by a Thumbnailer, or a program
+    passed to trust_fail_markers()), or None if there isn't one. The
+    marker may be out of date."""
+    leaf=_leaf(fname)
+    fail=os.path.join(os.environ['HOME'], '.thumbnails', 'fail')
+    for name in _fail_names:
+        path=os.path.join(fail, name, leaf)
+        if os.access(path, os.R_OK):
+            return path
+    return None
+
+def has_failed(fname):
+    """True if making a thumbnail for fname has already failed, either in
+    this process or according to a fail marker (see get_fail_path()), and
+    the file hasn't changed since. generate() and request_thumbnail() don't
+    try again for such files."""
+    try:
+        st=os.stat(fname)
+    except OSError:
+        return False
+    key=os.path.abspath(fname)
+    stamp=_failed.get(key)
+    if stamp is not None:
+        if stamp==_stamp(st):
+            return True
+        del _failed[key]        # Changed; try again
+    path=get_fail_path(fname)
+    if path and _is_valid(read_png_text(path), st):
+        _failed[key]=_stamp(st)
+        return True
+    return False
+
+def _note_failure(fname, st):
+    """Remember that making a thumbnail for fname (with stat results st,
+    from before the attempt) failed."""
+    _failed[os.path.abspath(fname)]=_stamp(st)
 
 def get_path(fname):
     """Given a file name return the full path of an existing thumbnail
@@ -37,6 +187,20 @@ def get_path(fname):
         if os.access(path, os.R_OK):
             return path
 
+def get_valid_path(fname):
+    """Like get_path(), but returns None if the thumbnail is out of date.
+    Only the start of the thumbnail is read, not the whole image."""
+    path=get_path(fname)
+    if not path:
+        return None
+    try:
+        st=os.stat(fname)
+    except OSError:
+        return None
+    if not _is_valid(read_png_text(path), st):
+        return None
+    return path
+
 def get_path_save(fname, ttype='normal'):
     """Given a file name return the full path of the location to store the
     thumbnail image.
@@ -48,23 +212,48 @@ def get_path_save(fname, ttype='normal'):
 
 def get_image(fname):
     """Given a file name return a GdkPixbuf of the thumbnail for that file.
-    If no thumbnail image exists return None."""
+    If no thumbnail image exists, or it is out of date, return None.
+    Recently loaded thumbnails are kept in memory, and are reused while
+    neither the file nor the thumbnail has changed. Out of date thumbnails
+    are spotted without decoding them."""
+    try:
+        s=os.stat(fname)
+    except OSError:
+        return None
+    key=os.path.abspath(fname)
+
+    entry=_index.get(key)
+    if entry:
+        path, tstamp, tsize, tmtime, pbuf=entry
+        try:
+            if _stamp(os.stat(path))==tstamp:
+                if tsize==int(s.st_size) and int(tmtime)==int(s.st_mtime):
+                    return pbuf
+                return None
+        except OSError:
+            pass
+        del _index[key]
+
     path=get_path(fname)
     if not path:
-	return None
+        return None
 
+    # Check validity
     try:
-        pbuf=rox.g.gdk.pixbuf_new_from_file(path)
-    except:
+        tstamp=_stamp(os.stat(path))
+    except OSError:
+        return None
+    text=read_png_text(path)
+    if not _is_valid(text, s):
         return None
 
-    # Check validity
-    tsize=int(pbuf.get_option('tEXt::Thumb::Size'))
-    tmtime=float(pbuf.get_option('tEXt::Thumb::MTime'))
-    s=os.stat(fname)
-    if tsize!=int(s.st_size) or int(tmtime)!=int(s.st_mtime):
+    try:
+        pbuf=rox.g.gdk.pixbuf_new_from_file(path)
+    except:
         return None
 
+    _index[key]=(path, tstamp, int(text['Thumb::Size']),
+                 float(text['Thumb::MTime']), pbuf)
     return pbuf
         
 
@@ -102,26 +291,291 @@ def get_method(path=None, mtype=None):
 
     return False
 
-def generate(path):
+def generate(path, size=NORMAL, fill_other=False):
     """Generate the thumbnail for a file.  If a generator for the type of
     path is not available then None is returned, otherwise an integer
-    which is the exit code of the generation process (0 for success)."""
+    which is the exit code of the generation process (0 for success).
+    If generation has already failed for this version of the file (see
+    has_failed()), it isn't tried again and 1 is returned, as it is if
+    the file has gone.
+
+    size should be NORMAL or LARGE. If fill_other is True and the image
+    is made internally, the thumbnail of the other size is made from the
+    same image too (unless it is already up to date)."""
     
     method=get_method(path)
     if not method:
         return None
 
+    if has_failed(path):
+        return 1
+    try:
+        st=os.stat(path)
+    except OSError:
+        return 1    # Gone since get_method() checked its type
+
     if method is True:
         th=GdkPixbufThumbnailer()
         
-        th.run(path)
-
-        return 0
+        th.run(path, None, size, _extra_sizes(path, size, fill_other))
+
+        status=th.failed and 1 or 0
+
+    else:
+        outname=get_path_save(path, _size_dir(size))
+        _make_dir(outname)
+
+        status=os.spawnl(os.P_WAIT, method, method, path, outname, str(size))
+
+    if status!=0:
+        _note_failure(path, st)
+    return status
+
+def _make_dir(outname):
+    """Create the directory for a thumbnail, if it is missing."""
+    d=os.path.dirname(outname)
+    if not os.path.isdir(d):
+        os.makedirs(d, 0700)
+
+def _size_dir(size):
+    """The thumbnail directory for images of the given size."""
+    if size<=NORMAL:
+        return 'normal'
+    return 'large'
+
+def _extra_sizes(path, size, fill_other):
+    """The other spec size to make along with size, if wanted and its
+    thumbnail isn't already up to date."""
+    if not fill_other:
+        return ()
+    if _size_dir(size)=='normal':
+        other=LARGE
+    else:
+        other=NORMAL
+    thumb=get_path_save(path, _size_dir(other))
+    try:
+        if _is_valid(read_png_text(thumb), os.stat(path)):
+            return ()
+    except OSError:
+        pass
+    return (other,)
+
+class _ThumbnailProcess(processes.Process):
+    """Runs a thumbnail generator in a child process. Internal
+    (GdkPixbuf) generation is done in the forked child itself."""
+    def __init__(self, method, path, outname, size, extra_sizes=()):
+        processes.Process.__init__(self)
+        self.method=method
+        self.path=path
+        self.outname=outname
+        self.size=size
+        self.extra_sizes=extra_sizes
+        self.done=tasks.Blocker()
+        self.status=None
+
+    def child_run(self):
+        if self.method is True:
+            th=GdkPixbufThumbnailer()
+            th.run(self.path, self.outname, self.size, self.extra_sizes)
+            os._exit(th.failed and 1 or 0)
+        os.execv(self.method, [self.method, self.path, self.outname,
+                               str(self.size)])
+
+    def child_died(self, status):
+        if os.WIFEXITED(status):
+            self.status=os.WEXITSTATUS(status)
+        else:
+            self.status=-1
+        self.done.trigger()
+
+class _Job:
+    """A thumbnail being made (or waiting to be), for one or more
+    ThumbnailRequests."""
+    def __init__(self, path, size):
+        self.path=path
+        self.size=size
+        self.requests=[]
+        self.queued=None        # Our entry in the queue, if waiting
+        self.fill_other=False
+        self.started=False
+        self.process=None
+
+class ThumbnailRequest(tasks.Blocker):
+    """A Blocker returned by request_thumbnail(). It is triggered when
+    the thumbnail has been made, when making it failed, or when the
+    request is cancelled. Afterwards, 'thumbnail' is the path of the
+    new thumbnail image (or None) and 'status' is the generator's exit
+    code (None if there is no generator for the file's type, or if the
+    request was cancelled, and 1 without running the generator if it
+    has already failed for this version of the file)."""
+    def __init__(self, service, job, priority):
+        tasks.Blocker.__init__(self)
+        self.path=job.path
+        self.size=job.size
+        self.priority=priority
+        self.thumbnail=None
+        self.status=None
+        self.cancelled=False
+        self._service=service
+        self._job=job
+
+    def set_priority(self, priority):
+        """Change the priority of the request (eg, when the file
+        scrolls into view). It has no effect once generation has
+        started."""
+        self.priority=priority
+        self._service._requeue(self._job)
+
+    def cancel(self):
+        """Withdraw the request (eg, when the file scrolls out of
+        view) and trigger the blocker. The thumbnail is still made if
+        generation has already started or another request for the same
+        file is waiting."""
+        if self.happened:
+            return
+        self.cancelled=True
+        self._service._cancel(self)
+        self.trigger()
+
+class ThumbnailService:
+    """Makes thumbnails in the background, running up to max_processes
+    generators at a time. Waiting requests are started highest priority
+    first, and requests for a file already waiting or being done share
+    the same generator. Most programs can just use request_thumbnail()."""
+    def __init__(self, max_processes=2):
+        self.max_processes=max_processes
+        self._jobs={}           # (path, size) -> _Job
+        self._queue=[]          # Heap of (-priority, seq, _Job)
+        self._seq=0
+        self._running=0
+
+    def request(self, path, size=NORMAL, priority=0, fill_other=False):
+        """Ask for a thumbnail of path to be made, and return a
+        ThumbnailRequest which will be triggered when it is ready.
+        Requests with higher priority are started first. fill_other is
+        as for generate()."""
+        path=os.path.abspath(path)
+        key=(path, size)
+        job=self._jobs.get(key)
+        if job is None:
+            job=_Job(path, size)
+            self._jobs[key]=job
+        job.fill_other=job.fill_other or fill_other
+        req=ThumbnailRequest(self, job, priority)
+        job.requests.append(req)
+        self._requeue(job)
+        return req
+
+    def set_max_processes(self, max_processes):
+        """Change the number of generators which may run at once."""
+        self.max_processes=max_processes
+        self._start_jobs()
+
+    def _requeue(self, job):
+        """Put job in the queue at the priority of its most urgent
+        request. Old entries are ignored when they reach the front."""
+        if job.started or not job.requests:
+            return
+        pri=max([r.priority for r in job.requests])
+        if job.queued and job.queued[0]==-pri:
+            return
+        self._seq+=1
+        job.queued=(-pri, self._seq, job)
+        heapq.heappush(self._queue, job.queued)
+        self._start_jobs()
+
+    def _cancel(self, req):
+        job=req._job
+        job.requests.remove(req)
+        if not job.requests and not job.started:
+            job.queued=None
+            del self._jobs[(job.path, job.size)]
+
+    def _next_job(self):
+        """Remove and return the most urgent waiting job, or None."""
+        while self._queue:
+            entry=heapq.heappop(self._queue)
+            job=entry[2]
+            if job.queued is entry:
+                job.queued=None
+                job.started=True
+                return job
+        return None
 
-    outname=get_path_save(path)
-    size=96
+    def _start_jobs(self):
+        while self._running<self.max_processes:
+            job=self._next_job()
+            if job is None:
+                break
+            self._running+=1
+            tasks.Task(self._run_job(job), 'thumbnail %s' % job.path)
 
-    return os.spawnl(os.P_WAIT, method, method, path, outname, str(size))
+    def _run_job(self, job):
+        status=None
+        try:
+            method=get_method(job.path)
+            if method and has_failed(job.path):
+                status=1
+            elif method:
+                try:
+                    st=os.stat(job.path)
+                    outname=get_path_save(job.path, _size_dir(job.size))
+                    _make_dir(outname)
+                    extra=()
+                    if method is True:
+                        extra=_extra_sizes(job.path, job.size,
+                                           job.fill_other)
+                    job.process=_ThumbnailProcess(method, job.path,
+                                                  outname, job.size, extra)
+                    job.process.start()
+                except OSError:
+                    # Eg, the file was deleted while the request waited
+                    job.process=None
+                    status=1
+                    return
+                yield job.process.done
+                status=job.process.status
+                if status!=0:
+                    _note_failure(job.path, st)
+        finally:
+            self._finished(job, status)
+
+    def _finished(self, job, status):
+        del self._jobs[(job.path, job.size)]
+        _forget(job.path)
+        self._running-=1
+        thumb=None
+        if status==0 and job.process and \
+               os.path.exists(job.process.outname):
+            thumb=job.process.outname
+        for req in job.requests:
+            req.thumbnail=thumb
+            req.status=status
+            req.trigger()
+        job.requests=[]
+        self._start_jobs()
+
+_service=None
+
+def _get_service():
+    global _service
+    if _service is None:
+        _service=ThumbnailService()
+    return _service
+
+def request_thumbnail(path, size=NORMAL, priority=0, fill_other=False):
+    """Make a thumbnail for path in the background. Returns a
+    ThumbnailRequest, a rox.tasks Blocker which is triggered when the
+    thumbnail is ready. Use its cancel() method if it is no longer
+    wanted, and set_priority() to move it up or down the queue. Files
+    which are visible should be given a higher priority than the rest.
+    size and fill_other are as for generate()."""
+    return _get_service().request(path, size, priority, fill_other)
+
+def set_max_processes(max_processes):
+    """Set how many thumbnail generators request_thumbnail() may run at
+    the same time (2 by default)."""
+    _get_service().set_max_processes(max_processes)
 
 # Class for thumbnail programs
 class Thumbnailer:
@@ -146,40 +600,61 @@ class Thumbnailer:
         """
         self.name=name
         self.fname=fname
+        _fail_names.add(fname)
         self.use_wdir=use_wdir
         self.debug=debug
 
         self.failed=False
 
-    def run(self, inname, outname=None, rsize=96):
+    def run(self, inname, outname=None, rsize=96, extra_sizes=()):
         """Generate the thumbnail from the file
         inname - source file
         outname - path to store thumbnail image, or None for default location
         rsize - maximum size of thumbnail (in either axis)
+        extra_sizes - other sizes to make from the same image, which are
+        stored in the default locations for those sizes (eg, (256,) to
+        make the 'large' thumbnail along with the 'normal' one)
+
+        The image is only loaded once, at the largest size needed, and
+        each smaller thumbnail is scaled down from the one before.
         """
         if not outname:
-            outname=get_path_save(inname)
+            outname=get_path_save(inname, _size_dir(rsize))
 
         elif not os.path.isabs(outname):
             outname=os.path.abspath(outname)
 
+        targets=[(rsize, outname)]
+        for size in extra_sizes:
+            targets.append((size, get_path_save(inname, _size_dir(size))))
+        targets.sort(reverse=True)
+
         if self.use_wdir:
             self.make_working_dir()
 
         try:
-            img=self.get_image(inname, rsize)
+            img=self.get_image(inname, targets[0][0])
             if img:
                 ow=img.get_width()
                 oh=img.get_height()        
-                img=self.process_image(img, rsize)
-                self.store_image(img, inname, outname, ow, oh)
+                for size, path in targets:
+                    img=self.scale_image(img, size)
+                    _make_dir(path)
+                    self.store_image(self.process_image(img, size),
+                                     inname, path, ow, oh)
 
             else:
                 # Thumbnail creation has failed.
                 self.creation_failed(inname, outname, rsize)
             
         except:
+            # Eg, a corrupt image. Mark it so that it isn't tried again.
             self.report_exception()
+            self.failed=True
+            try:
+                self.creation_failed(inname, outname, rsize)
+            except:
+                self.report_exception()
 
         if self.use_wdir:
             self.remove_working_dir()
@@ -188,23 +663,28 @@ class Thumbnailer:
         """Method you must define for your thumbnailer to do anything"""
         raise _("Thumbnail not implemented")
 
-    def process_image(self, img, rsize):
-        """Take the raw image and scale it to the correct size.
-        Returns the result of scaling img and passing it to
-        post_process_image()"""
+    def scale_image(self, img, rsize):
+        """Scale img so that its larger side is rsize pixels."""
         ow=img.get_width()
         oh=img.get_height()
         if ow>oh:
-            s=float(rsize)/float(ow)
+            w=rsize
+            h=max(1, int(float(rsize)*oh/ow))
         else:
-            s=float(rsize)/float(oh)
-        w=int(s*ow)
-        h=int(s*oh)
+            w=max(1, int(float(rsize)*ow/oh))
+            h=rsize
 
         if w!=ow or h!=oh:
             img=img.scale_simple(w, h, rox.g.gdk.INTERP_BILINEAR)
+        return img
 
-        return self.post_process_image(img, w, h)
+    def process_image(self, img, rsize):
+        """Take the raw image and scale it to the correct size.
+        Returns the result of scaling img and passing it to
+        post_process_image()"""
+        img=self.scale_image(img, rsize)
+        return self.post_process_image(img, img.get_width(),
+                                       img.get_height())
 
     def post_process_image(self, img, w, h):
         """Perform some post-processing on the image.
@@ -228,6 +708,7 @@ class Thumbnailer:
               'tEXt::Thumb::URI': rox.escape('file://'+inname),
               'tEXt::Software': self.name})
         os.rename(outname+self.fname, outname)
+        _forget(inname)
         self.created=outname
         
     def make_working_dir(self):
@@ -304,3 +785,160 @@ class GdkPixbufThumbnailer(Thumbnailer):
 
         return img
 
+
+class ThumbnailCleaner:
+    """Removes thumbnails (and fail markers) from ~/.thumbnails which are
+    no longer useful: those for files which have been deleted or changed,
+    and unreadable ones. Optionally, thumbnails which haven't been used
+    for max_age seconds are removed too, and then the least recently used
+    ones until the rest take up no more than max_bytes. Thumbnails for
+    files which aren't local are only removed for age and size.
+
+    Use run() to do it all at once, or start() to do it in the background
+    with a rox.tasks Task. Afterwards, 'stats' says what was done."""
+    def __init__(self, max_bytes=None, max_age=None, dry_run=False,
+                 chunk=50):
+        """If dry_run is True, the statistics are collected but nothing
+        is removed. A Task does 'chunk' files at a time."""
+        self.max_bytes=max_bytes
+        self.max_age=max_age
+        self.dry_run=dry_run
+        self.chunk=chunk
+        self.stats={'scanned': 0, 'kept': 0, 'bytes_scanned': 0,
+                    'bytes_kept': 0, 'removed_missing': 0,
+                    'removed_stale': 0, 'removed_invalid': 0,
+                    'removed_age': 0, 'removed_budget': 0,
+                    'bytes_freed': 0}
+
+    def run(self):
+        """Clean the cache now, and return the statistics."""
+        for x in self.steps():
+            pass
+        return self.stats
+
+    def start(self):
+        """Clean the cache in the background. Returns the Task; wait for
+        its 'finished' Blocker."""
+        return tasks.Task(self.steps(), 'clean thumbnails')
+
+    def _files(self):
+        top=os.path.join(os.environ['HOME'], '.thumbnails')
+        dirs=[os.path.join(top, 'normal'), os.path.join(top, 'large')]
+        dirs+=_get_fail_dirs()
+        for d in dirs:
+            try:
+                leaves=os.listdir(d)
+            except OSError:
+                continue
+            for leaf in leaves:
+                if leaf.endswith('.png'):
+                    yield os.path.join(d, leaf)
+
+    def _remove(self, path, size, reason):
+        if not self.dry_run:
+            try:
+                os.unlink(path)
+            except OSError:
+                return
+        self.stats['removed_'+reason]+=1
+        self.stats['bytes_freed']+=size
+
+    def _check(self, path, text):
+        """Why the thumbnail 'path' should be removed, or None."""
+        if text is None or 'Thumb::URI' not in text:
+            return 'invalid'
+        source=rox.get_local_path(text['Thumb::URI'])
+        if source is None:
+            return None
+        try:
+            st=os.stat(source)
+        except OSError:
+            return 'missing'
+        try:
+            if int(float(text['Thumb::MTime']))!=int(st.st_mtime):
+                return 'stale'
+            if 'Thumb::Size' in text and \
+                   int(text['Thumb::Size'])!=st.st_size:
+                return 'stale'
+        except (KeyError, ValueError):
+            return 'invalid'
+        return None
+
+    def steps(self):
+        """A generator which does the cleaning, yielding None every
+        'chunk' files. Used by run() and start()."""
+        stats=self.stats
+        kept=[]             # (atime, size, path)
+        now=time.time()
+        for path in self._files():
+            stats['scanned']+=1
+            if stats['scanned']%self.chunk==0:
+                yield None
+            try:
+                st=os.stat(path)
+            except OSError:
+                continue
+            stats['bytes_scanned']+=st.st_size
+            text=read_png_text(path)
+            # Reading it may have updated the atime (eg, on relatime
+            # mounts), which the age and size limits depend on
+            try:
+                os.utime(path, (st.st_atime, st.st_mtime))
+            except OSError:
+                pass
+            reason=self._check(path, text)
+            if reason is None and self.max_age is not None and \
+                   st.st_atime<now-self.max_age:
+                reason='age'
+            if reason:
+                self._remove(path, st.st_size, reason)
+            else:
+                kept.append((st.st_atime, st.st_size, path))
+
+        total=sum([size for atime, size, path in kept])
+        removed=0
+        if self.max_bytes is not None and total>self.max_bytes:
+            kept.sort()
+            while removed<len(kept) and total>self.max_bytes:
+                atime, size, path=kept[removed]
+                self._remove(path, size, 'budget')
+                total-=size
+                removed+=1
+        stats['kept']=len(kept)-removed
+        stats['bytes_kept']=total
+        _index.clear()
+
+def clean_cache(max_bytes=None, max_age=None, dry_run=False):
+    """Remove useless thumbnails now, returning a dictionary of
+    statistics. See ThumbnailCleaner for details."""
+    return ThumbnailCleaner(max_bytes, max_age, dry_run).run()
+
+def _main():
+    """Command-line interface to ThumbnailCleaner."""
+    from optparse import OptionParser
+    parser=OptionParser(usage='usage: %prog [options]',
+                        description='Remove old thumbnails from '
+                        '~/.thumbnails.')
+    parser.add_option('-s', '--max-size', type='float',
+                      help='keep no more than this many MB')
+    parser.add_option('-a', '--max-age', type='float',
+                      help='remove thumbnails unused for this many days')
+    parser.add_option('-n', '--dry-run', action='store_true',
+                      help='just report what would be removed')
+    options, args=parser.parse_args()
+    if args:
+        parser.error('unexpected arguments')
+
+    max_bytes=max_age=None
+    if options.max_size is not None:
+        max_bytes=int(options.max_size*1024*1024)
+    if options.max_age is not None:
+        max_age=options.max_age*24*60*60
+    stats=clean_cache(max_bytes, max_age, options.dry_run)
+    keys=stats.keys()
+    keys.sort()
+    for key in keys:
+        print '%s: %d' % (key, stats[key])
+
+if __name__=='__main__':
+    _main()
@@ -40,6 +40,9 @@ class NoXAttr(OSError):
         
 # Well known extended attribute names.
 USER_MIME_TYPE = 'user.mime_type'
+# Set along with USER_MIME_TYPE when rox.mime stores a type it found
+# itself, to record the size and mtime of the file at the time.
+ROX_MIME_TYPE_STAMP = 'user.rox.mime_type_stamp'
 
 if libc and hasattr(libc, 'attropen'):
     # Solaris style
@@ -0,0 +1,266 @@
+#!/usr/bin/env python2.6
+"""Benchmarks for rox.mime.
+
+Generates a MIME database with many types (in a private XDG_DATA_DIRS) and
+a corpus of files of those types, of many sizes, and then times the
+lookup functions against it, once using the database's mime.cache and once
+using only the globs and magic text files. Each run is done in a fresh
+process, so that the load times and memory use are realistic.
+
+The results are written as JSON, to stdout or the file given with
+--output, so that they can be compared between versions. A summary is
+printed to stderr.
+
+Needs update-mime-database (from shared-mime-info)."""
+
+import os, sys, time, shutil, random
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+rox_lib = dirname(dirname(dirname(abspath(sys.argv[0]))))
+sys.path.insert(0, join(rox_lib, 'python'))
+
+try:
+	import json
+except ImportError:
+	json = None
+
+FORMAT_VERSION = 1
+
+sizes = [0, 16, 512, 4096, 65536, 1 << 20]
+size_weights = [2, 10, 30, 30, 20, 8]
+
+def type_name(i):
+	return 'application/x-bench-%d' % i
+
+def magic_header(i):
+	"""The data at the start of files of type i, and the XML for the
+	magic rules which match it. The kinds of rule vary with i."""
+	kind = i % 5
+	if kind == 0:
+		value = 'BNCH%04d' % i
+		return value, '<match type="string" offset="0" value="%s"/>' % value
+	elif kind == 1:
+		value = 'RNG%04d' % i
+		return 'x' * (i % 40) + value, \
+			'<match type="string" offset="0:64" value="%s"/>' % value
+	elif kind == 2:
+		value = 'NST%04d' % i
+		return 'NEST' + value, \
+			'<match type="string" offset="0" value="NEST">' \
+			'<match type="string" offset="4" value="%s"/></match>' % value
+	elif kind == 3:
+		return 'MSK' + chr(i % 256) + 'm%05d' % i, \
+			'<match type="big32" offset="0" value="0x4d534b00" ' \
+			'mask="0xffffff00"><match type="string" offset="4" ' \
+			'value="m%05d"/></match>' % i
+	value = 'HDR%04d' % i
+	return ' ' * 8 + value, \
+		'<match type="string" offset="8" value="%s"/>' % value
+
+def make_package(ntypes):
+	"""XML for a package file defining ntypes types."""
+	out = ['<?xml version="1.0"?>\n'
+	       '<mime-info xmlns="http://www.freedesktop.org/standards/'
+	       'shared-mime-info">\n']
+	for i in range(ntypes):
+		header, rules = magic_header(i)
+		out.append('<mime-type type="%s">\n' % type_name(i))
+		out.append('  <comment>Benchmark type %d</comment>\n' % i)
+		if i % 7 == 0:
+			out.append('  <sub-class-of type="text/plain"/>\n')
+		out.append('  <glob pattern="*.b%d"/>\n' % i)
+		if i % 3 == 0:
+			out.append('  <glob pattern="bench%d-*.log"/>\n' % i)
+		if i % 11 == 0:
+			out.append('  <glob pattern="BENCHLIT%d"/>\n' % i)
+		pri = [50, 50, 50, 80, 30][i % 5]
+		out.append('  <magic priority="%d">%s</magic>\n' % (pri, rules))
+		out.append('</mime-type>\n')
+	out.append('</mime-info>\n')
+	return ''.join(out)
+
+def make_database(dir, ntypes):
+	"""Create dir/share-cache and dir/share-text, each with a mime
+	directory built from the same package. The second has no mime.cache."""
+	cache_share = join(dir, 'share-cache')
+	packages = join(cache_share, 'mime', 'packages')
+	os.makedirs(packages)
+	file(join(packages, 'bench.xml'), 'w').write(make_package(ntypes))
+	os.environ['XDG_DATA_DIRS'] = cache_share
+	if os.spawnlp(os.P_WAIT, 'update-mime-database', 'update-mime-database',
+		      join(cache_share, 'mime')):
+		raise Exception('update-mime-database failed')
+	text_share = join(dir, 'share-text')
+	shutil.copytree(cache_share, text_share)
+	os.unlink(join(text_share, 'mime', 'mime.cache'))
+
+def make_corpus(dir, nfiles, ntypes, seed):
+	"""Write nfiles files to dir and return their paths. Some can be
+	identified by name and contents, some only by one of them, and some
+	not at all."""
+	rng = random.Random(seed)
+	noise = ''.join([chr(rng.randrange(256)) for i in xrange(65536)])
+	choices = []
+	for size, weight in zip(sizes, size_weights):
+		choices += [size] * weight
+	os.makedirs(dir)
+	paths = []
+	for n in xrange(nfiles):
+		i = rng.randrange(ntypes)
+		kind = rng.choice(['both', 'both', 'magic', 'name', 'glob',
+				   'unknown'])
+		if kind in ('both', 'name'):
+			leaf = 'f%d.b%d' % (n, i)
+		elif kind == 'glob':
+			i -= i % 3
+			leaf = 'bench%d-%d.log' % (i, n)
+		elif kind == 'unknown':
+			leaf = 'f%d.unknown' % n
+		else:
+			leaf = 'f%d' % n
+		size = rng.choice(choices)
+		if kind in ('both', 'magic'):
+			data = magic_header(i)[0]
+		else:
+			data = ''
+		start = rng.randrange(len(noise))
+		while len(data) < size:
+			data += noise[start:start + size - len(data)]
+			start = 0
+		path = join(dir, leaf)
+		file(path, 'wb').write(data)
+		paths.append(path)
+	return paths
+
+def rss_kb():
+	"""The resident set size of this process in KB, or None."""
+	try:
+		for line in file('/proc/self/status'):
+			if line.startswith('VmRSS:'):
+				return int(line.split()[1])
+	except IOError:
+		pass
+	return None
+
+def best_of(repeat, fn, args):
+	"""Time calling fn on each of args, repeat times. Returns the best
+	total time."""
+	best = None
+	for r in range(repeat):
+		start = time.time()
+		for a in args:
+			fn(a)
+		t = time.time() - start
+		if best is None or t < best:
+			best = t
+	return best
+
+def run_worker(dir, database, repeat):
+	"""Time the lookups in this process, using the given database, and
+	return a dictionary of results."""
+	os.environ['XDG_DATA_HOME'] = join(dir, 'empty')
+	os.environ['XDG_DATA_DIRS'] = join(dir, 'share-' + database)
+	os.environ['XDG_CACHE_HOME'] = join(dir, 'cache')
+	corpus = join(dir, 'corpus')
+	leaves = os.listdir(corpus)
+	leaves.sort()
+	paths = [join(corpus, leaf) for leaf in leaves]
+
+	results = {'rss_start_kb': rss_kb()}
+	start = time.time()
+	from rox import mime
+	results['import_s'] = time.time() - start
+
+	start = time.time()
+	mime.get_type_by_name('x.b0')
+	results['load_names_s'] = time.time() - start
+	start = time.time()
+	mime.get_type_by_contents(paths[0])
+	results['load_magic_s'] = time.time() - start
+	results['rss_loaded_kb'] = rss_kb()
+
+	# Read everything once so that the disk cache is warm
+	for path in paths:
+		file(path).read(4096)
+
+	found = 0
+	for path in paths:
+		if mime.get_type(path) is not mime.text:
+			found += 1
+	results['identified'] = found
+
+	for name, fn, args in [
+			('get_type_by_name', mime.get_type_by_name, leaves),
+			('get_type_by_contents', mime.get_type_by_contents, paths),
+			('get_type', mime.get_type, paths)]:
+		t = best_of(repeat, fn, args)
+		results[name] = {'total_s': t,
+				 'per_call_us': t * 1e6 / len(args)}
+	results['rss_end_kb'] = rss_kb()
+	return results
+
+def main():
+	parser = OptionParser(usage = 'usage: %prog [options]')
+	parser.add_option('-d', '--dir', default = '/tmp/rox-mime-bench',
+			  help = 'where to create the database and files')
+	parser.add_option('-f', '--files', type = 'int', default = 2000,
+			  help = 'number of files in the corpus')
+	parser.add_option('-t', '--types', type = 'int', default = 1000,
+			  help = 'number of types in the database')
+	parser.add_option('-r', '--repeat', type = 'int', default = 3,
+			  help = 'take the best of this many runs')
+	parser.add_option('-s', '--seed', type = 'int', default = 1,
+			  help = 'random seed for the corpus')
+	parser.add_option('-o', '--output', help = 'write results to this file')
+	parser.add_option('--worker', help = 'internal: time one database')
+	options, args = parser.parse_args()
+	if json is None:
+		parser.error('Needs the json module (Python 2.6 or later)')
+
+	if options.worker:
+		results = run_worker(options.dir, options.worker, options.repeat)
+		json.dump(results, sys.stdout)
+		return
+
+	if os.path.isdir(options.dir):
+		shutil.rmtree(options.dir)
+	make_database(options.dir, options.types)
+	make_corpus(join(options.dir, 'corpus'), options.files, options.types,
+		    options.seed)
+
+	report = {'format': FORMAT_VERSION,
+		  'python': sys.version.split()[0],
+		  'files': options.files,
+		  'types': options.types,
+		  'seed': options.seed,
+		  'repeat': options.repeat,
+		  'results': {}}
+	for database in ('cache', 'text'):
+		child = os.popen('"%s" "%s" --worker %s --dir "%s" --repeat %d' %
+				 (sys.executable, abspath(sys.argv[0]), database,
+				  options.dir, options.repeat))
+		output = child.read()
+		if child.close():
+			raise Exception('Benchmark failed for ' + database)
+		results = json.loads(output)
+		report['results'][database] = results
+
+		print >>sys.stderr, '%s: load %.3fs names + %.3fs magic, ' \
+			'RSS %s KB, %d/%d identified' % (database,
+			results['load_names_s'], results['load_magic_s'],
+			results['rss_loaded_kb'], results['identified'],
+			options.files)
+		for name in ('get_type_by_name', 'get_type_by_contents',
+			     'get_type'):
+			print >>sys.stderr, '  %-22s %8.1f us/call' % (name,
+				results[name]['per_call_us'])
+
+	if options.output:
+		stream = file(options.output, 'w')
+	else:
+		stream = sys.stdout
+	json.dump(report, stream, indent = 1, sort_keys = True)
+	stream.write('\n')
+
+if __name__ == '__main__':
+	main()
@@ -21,7 +21,8 @@ class TestBasedir(unittest.TestCase):
 
 	def testDefaults(self):
 		for x in ['XDG_DATA_HOME', 'XDG_DATA_DIRS',
-			  'XDG_CONFIG_HOME', 'XDG_CONFIG_DIRS']:
+			  'XDG_CONFIG_HOME', 'XDG_CONFIG_DIRS',
+			  'XDG_CACHE_HOME']:
 			if x in os.environ:
 				del os.environ[x]
 		reload(basedir)
@@ -30,6 +31,9 @@ class TestBasedir(unittest.TestCase):
 		self.assertEquals([basedir.xdg_config_home, '/etc/xdg'],
 				  basedir.xdg_config_dirs)
 
+		self.assertEquals(os.path.expanduser('~/.cache'),
+				  basedir.xdg_cache_home)
+
 		self.assertEquals(os.path.expanduser('~/.local/share'),
 				  basedir.xdg_data_home)
 		self.assertEquals([basedir.xdg_data_home,
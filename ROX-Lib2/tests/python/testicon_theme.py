@@ -1,10 +1,11 @@
 #!/usr/bin/env python2.6
 import unittest
-import os, sys, shutil
+import os, sys, shutil, struct, time
 from os.path import dirname, abspath, join
 rox_lib = dirname(dirname(dirname(abspath(sys.argv[0]))))
 sys.path.insert(0, join(rox_lib, 'python'))
 
+import rox
 from rox import icon_theme
 from StringIO import StringIO
 
@@ -21,7 +22,132 @@ a = Hello
   #  Another comment
   b = 2""")
 
+test_dir = '/tmp/rox-icon-theme-test'
+
+test_theme = """[Icon Theme]
+Name=Test
+Directories=16x16/apps,48x48/apps,scalable/apps
+
+[16x16/apps]
+Size=16
+Type=Fixed
+
+[48x48/apps]
+Size=48
+Type=Threshold
+Threshold=2
+
+[scalable/apps]
+Size=48
+Type=Scaled
+MinSize=8
+MaxSize=32
+"""
+
+def make_icon_cache(path, dirs, icons, n_buckets = 3):
+	"""Write an icon-theme.cache. icons maps names to lists of
+	(dir, flags) pairs."""
+	def name_hash(name):
+		h = 0
+		for c in name:
+			h = (h * 31 + struct.unpack('b', c)[0]) & 0xffffffff
+		return h
+	strings = []
+	def string_offset(s):
+		strings.append(s)
+		return len(strings) - 1		# Fixed up below
+
+	icons = icons.items()
+	buckets = [[] for i in range(n_buckets)]
+	for name, images in icons:
+		buckets[name_hash(name) % n_buckets].append((name, images))
+
+	# Header, hash, icon records, image lists, directory list, strings
+	offset = 12 + 4 + 4 * n_buckets
+	records = []
+	for bucket in buckets:
+		for name, images in bucket:
+			records.append((offset, name, images))
+			offset += 12
+	image_lists = []
+	for record, name, images in records:
+		image_lists.append(offset)
+		offset += 4 + 8 * len(images)
+	dir_list = offset
+	offset += 4 + 4 * len(dirs)
+	string_offsets = {}
+	for s in [name for name, images in icons] + dirs:
+		string_offsets[s] = offset
+		offset += len(s) + 1
+
+	data = struct.pack('>HHLL', 1, 0, 12, dir_list)
+	data += struct.pack('>L', n_buckets)
+	i = 0
+	for bucket in buckets:
+		if bucket:
+			data += struct.pack('>L', records[i][0])
+			i += len(bucket)
+		else:
+			data += struct.pack('>L', 0xffffffff)
+	i = 0
+	for bucket in buckets:
+		for j in range(len(bucket)):
+			record, name, images = records[i]
+			if j + 1 < len(bucket):
+				chain = records[i + 1][0]
+			else:
+				chain = 0xffffffff
+			data += struct.pack('>LLL', chain, string_offsets[name],
+					    image_lists[i])
+			i += 1
+	for record, name, images in records:
+		data += struct.pack('>L', len(images))
+		for dir, flags in images:
+			data += struct.pack('>HHL', dirs.index(dir), flags, 0)
+	data += struct.pack('>L', len(dirs))
+	for d in dirs:
+		data += struct.pack('>L', string_offsets[d])
+	for s in [name for name, images in icons] + dirs:
+		data += s + '\0'
+	file(path, 'wb').write(data)
+
+class Pixbuf:
+	"""Enough of a pixbuf for load_pixbuf()."""
+	def __init__(self, w, h):
+		self.w = w
+		self.h = h
+	def get_width(self): return self.w
+	def get_height(self): return self.h
+	def get_rowstride(self): return self.w * 4
+	def scale_simple(self, w, h, interp):
+		return Pixbuf(w, h)
+
 class TestIconTheme(unittest.TestCase):
+	def setUp(self):
+		if os.path.isdir(test_dir):
+			shutil.rmtree(test_dir)
+		self.old_theme_dirs = icon_theme.theme_dirs
+		icon_theme.theme_dirs = [test_dir]
+		icon_theme._rox_themes.clear()
+
+	def tearDown(self):
+		icon_theme.theme_dirs = self.old_theme_dirs
+		if os.path.isdir(test_dir):
+			shutil.rmtree(test_dir)
+
+	def make_theme(self, name, index, icons):
+		theme = join(test_dir, name)
+		os.makedirs(theme)
+		file(join(theme, 'index.theme'), 'w').write(index)
+		for icon in icons:
+			self.add_icon(name, icon)
+
+	def add_icon(self, theme, icon):
+		path = join(test_dir, theme, icon)
+		if not os.path.isdir(dirname(path)):
+			os.makedirs(dirname(path))
+		file(path, 'w').close()
+
 	def testParser(self):
 		i = icon_theme._ini_parser(test_index)
 		self.assertEquals(("Section", "a", "1"), i.next())
@@ -43,6 +169,184 @@ class TestIconTheme(unittest.TestCase):
 		except Exception:
 			pass
 
+	def testLookup(self):
+		self.make_theme('Test', test_theme, ['16x16/apps/a.png',
+			'48x48/apps/a.png', 'scalable/apps/b.svg',
+			'48x48/apps/c.svg', '48x48/apps/c.png'])
+		theme = icon_theme.IconThemeROX('Test')
+		lookup = theme.lookup_icon
+		self.assertEquals(join(test_dir, 'Test/16x16/apps/a.png'),
+				  lookup('a', 16))
+		self.assertEquals(join(test_dir, 'Test/48x48/apps/a.png'),
+				  lookup('a', 40))
+		self.assertEquals(join(test_dir, 'Test/scalable/apps/b.svg'),
+				  lookup('b', 100))
+		self.assertEquals(join(test_dir, 'Test/48x48/apps/c.png'),
+				  lookup('c', 48))
+		self.assertEquals(None, lookup('missing', 48))
+
+		index = theme.indexes[0]
+		self.assertEquals([(0, '48x48/apps'), (16, 'scalable/apps'),
+				   (32, '16x16/apps')], index.subdirs_for_size(48))
+
+		# New icons are noticed when the directory changes
+		self.add_icon('Test', '16x16/apps/new.png')
+		os.utime(join(test_dir, 'Test/16x16/apps'), (1, 1))
+		index._checked = 0
+		self.assertEquals(join(test_dir, 'Test/16x16/apps/new.png'),
+				  lookup('new', 16))
+
+	def testInherits(self):
+		def index(inherits):
+			return test_theme.replace('Name=Test',
+					'Name=Test\nInherits=' + inherits)
+		self.make_theme('Child', index('Parent, Other'),
+				['16x16/apps/a.png'])
+		self.make_theme('Parent', index('Grandparent'),
+				['16x16/apps/a.png', '16x16/apps/b.png'])
+		self.make_theme('Grandparent', index('Child'),
+				['48x48/apps/c.png', '16x16/apps/d.png'])
+		self.make_theme('Other', test_theme, ['16x16/apps/d.png'])
+		self.make_theme('hicolor', test_theme, ['16x16/apps/e.png'])
+
+		theme = icon_theme.IconThemeROX('Child')
+		self.assertEquals(['Child', 'Parent', 'Grandparent', 'Other',
+				   'hicolor'], [t.name for t in theme.get_chain()])
+		lookup = theme.lookup_icon
+		self.assertEquals(join(test_dir, 'Child/16x16/apps/a.png'),
+				  lookup('a', 16))
+		self.assertEquals(join(test_dir, 'Parent/16x16/apps/b.png'),
+				  lookup('b', 16))
+		self.assertEquals(join(test_dir, 'Grandparent/48x48/apps/c.png'),
+				  lookup('c', 16))
+		self.assertEquals(join(test_dir, 'Grandparent/16x16/apps/d.png'),
+				  lookup('d', 16))
+		self.assertEquals(join(test_dir, 'hicolor/16x16/apps/e.png'),
+				  lookup('e', 16))
+
+		# Misses are remembered until it's time to check for changes
+		self.assertEquals(None, lookup('f', 16))
+		self.add_icon('hicolor', '16x16/apps/f.png')
+		os.utime(join(test_dir, 'hicolor/16x16/apps'), (1, 1))
+		for t in theme.get_chain():
+			for i in t.indexes:
+				i._checked = 0
+		self.assertEquals(None, lookup('f', 16))
+		theme._missing_checked = 0
+		self.assertEquals(join(test_dir, 'hicolor/16x16/apps/f.png'),
+				  lookup('f', 16))
+
+		# A theme with no directories still gets hicolor
+		theme = icon_theme.IconThemeROX('Missing')
+		self.assertEquals(['hicolor'], [t.name for t in theme.get_chain()])
+		self.assertEquals(join(test_dir, 'hicolor/16x16/apps/e.png'),
+				  theme.lookup_icon('e', 16))
+
+	def testIconCache(self):
+		self.make_theme('Test', test_theme, ['16x16/apps/a.png'])
+		cache = join(test_dir, 'Test', 'icon-theme.cache')
+		make_icon_cache(cache, ['48x48/apps', 'scalable/apps', '16x16/apps'],
+			{'cached': [('16x16/apps', 4), ('scalable/apps', 2)],
+			 'both': [('48x48/apps', 6)],
+			 'caf\xc3\xa9': [('16x16/apps', 4)],
+			 'xpm': [('16x16/apps', 1)],
+			 'b': [], 'c': [], 'd': [], 'e': []})
+		future = time.time() + 10
+		os.utime(cache, (future, future))
+
+		theme = icon_theme.IconThemeROX('Test')
+		lookup = theme.lookup_icon
+		self.assertEquals(join(test_dir, 'Test/16x16/apps/cached.png'),
+				  lookup('cached', 16))
+		self.assertEquals(join(test_dir, 'Test/scalable/apps/cached.svg'),
+				  lookup('cached', 24))
+		self.assertEquals(join(test_dir, 'Test/48x48/apps/both.png'),
+				  lookup('both', 48))
+		self.assertEquals(join(test_dir, 'Test/16x16/apps/caf\xc3\xa9.png'),
+				  lookup('caf\xc3\xa9', 16))
+		for name in ('a', 'xpm', 'b', 'e', 'missing'):
+			self.assertEquals(None, lookup(name, 16))
+		assert theme.indexes[0]._icons is None
+
+		# An out-of-date cache isn't used
+		os.utime(cache, (1, 1))
+		theme.indexes[0]._checked = 0
+		theme._missing_checked = 0
+		self.assertEquals(join(test_dir, 'Test/16x16/apps/a.png'),
+				  lookup('a', 16))
+		self.assertEquals(None, lookup('cached', 16))
+
+	def testPixbufCache(self):
+		gdk = rox.g.gdk
+		loads = []
+		def load(path, w, h):
+			loads.append((path, w))
+			if path == 'large': w *= 100
+			return Pixbuf(w, h / 2)
+		old = getattr(gdk, 'pixbuf_new_from_file_at_size', None)
+		gdk.pixbuf_new_from_file_at_size = load
+		try:
+			icon_theme.set_pixbuf_cache(16 * 8 * 4 * 10)
+			a = icon_theme.load_pixbuf('a', 16)
+			self.assertEquals((16, 8), (a.get_width(), a.get_height()))
+			assert icon_theme.load_pixbuf('a', 16) is a
+			b = icon_theme.load_pixbuf('a', 16, width = 8)
+			self.assertEquals((8, 4), (b.get_width(), b.get_height()))
+			assert icon_theme.load_pixbuf('a', 16, width = 8) is b
+			assert icon_theme.load_pixbuf('a', 16, 1) is not a
+			self.assertEquals([('a', 16), ('a', 16)], loads)
+
+			# Too big to cache
+			icon_theme.load_pixbuf('large', 16)
+			icon_theme.load_pixbuf('large', 16)
+			self.assertEquals(4, len(loads))
+
+			stats = icon_theme.get_pixbuf_cache_stats()
+			self.assertEquals(3, stats['size'])
+			self.assertEquals(16 * 8 * 4 * 2 + 8 * 4 * 4, stats['used'])
+			self.assertEquals(3, stats['hits'])
+
+			icon_theme.clear_pixbuf_cache()
+			assert icon_theme.load_pixbuf('a', 16) is not a
+
+			icon_theme.set_pixbuf_cache(0)
+			self.assertEquals(None, icon_theme.get_pixbuf_cache_stats())
+			assert icon_theme.load_pixbuf('a', 16) is not \
+			       icon_theme.load_pixbuf('a', 16)
+		finally:
+			icon_theme.set_pixbuf_cache(4 << 20)
+			if old is None:
+				del gdk.pixbuf_new_from_file_at_size
+			else:
+				gdk.pixbuf_new_from_file_at_size = old
+
+	def testLazy(self):
+		def fail(*args):
+			raise AssertionError('Filesystem access on import')
+		patched = [(os, 'stat'), (os, 'listdir'), (os.path, 'exists'),
+			   (os.path, 'isdir'), (os.path, 'isfile')]
+		old = [getattr(m, name) for m, name in patched]
+		for m, name in patched:
+			setattr(m, name, fail)
+		try:
+			reload(icon_theme)
+		finally:
+			for (m, name), f in zip(patched, old):
+				setattr(m, name, f)
+		self.assertEquals(None, icon_theme.theme_dirs)
+		self.assertEquals(None, icon_theme.rox_theme._theme)
+		self.assertEquals(None, icon_theme.users_theme._theme)
+
+		icon_theme.theme_dirs = [test_dir]
+		rox_theme = icon_theme.rox_theme
+		self.assertEquals('ROX', rox_theme.name)
+		assert isinstance(rox_theme._theme, icon_theme.IconTheme)
+
+		self.make_theme('Test', test_theme, ['16x16/apps/a.png'])
+		theme = icon_theme._LazyTheme(lambda: icon_theme.IconThemeROX('Test'))
+		self.assertEquals(join(test_dir, 'Test/16x16/apps/a.png'),
+				  theme.lookup_icon('a', 16))
+
 suite = unittest.makeSuite(TestIconTheme)
 if __name__ == '__main__':
 	sys.argv.append('-v')
@@ -0,0 +1,72 @@
+#!/usr/bin/env python2.6
+import unittest
+import os, sys
+from os.path import dirname, abspath, join
+rox_lib = dirname(dirname(dirname(abspath(sys.argv[0]))))
+sys.path.insert(0, join(rox_lib, 'python'))
+
+from rox.lru import LRUCache
+
+class TestLRU(unittest.TestCase):
+	def testEviction(self):
+		cache = LRUCache(2)
+		cache['a'] = 1
+		cache['b'] = 2
+		self.assertEquals(1, cache.get('a'))
+		cache['c'] = 3
+		self.assertEquals(['a', 'c'], cache.keys())
+		self.assertEquals(None, cache.get('b'))
+		self.assertEquals(1, cache.evictions)
+
+	def testCounters(self):
+		cache = LRUCache(10)
+		cache['a'] = 1
+		cache.get('a')
+		cache.get('a')
+		cache.get('missing')
+		self.assertEquals({'size': 1, 'capacity': 10, 'hits': 2,
+				   'misses': 1, 'evictions': 0}, cache.stats())
+
+	def testValid(self):
+		cache = LRUCache(10)
+		cache['a'] = 1
+		self.assertEquals(1, cache.get('a', valid = lambda v: v == 1))
+		self.assertEquals(None, cache.get('a', valid = lambda v: v == 2))
+		self.assertEquals('x', cache.get('a', 'x', lambda v: False))
+		self.assertEquals((1, 2), (cache.hits, cache.misses))
+
+	def testReplace(self):
+		cache = LRUCache(2)
+		cache['a'] = 1
+		cache['b'] = 2
+		cache['a'] = 3
+		self.assertEquals(['b', 'a'], cache.keys())
+		self.assertEquals(3, cache['a'])
+		del cache['b']
+		assert 'b' not in cache
+		self.assertEquals(1, len(cache))
+		cache.clear()
+		self.assertEquals([], cache.keys())
+
+	def testSizeof(self):
+		cache = LRUCache(10, len)
+		cache['a'] = 'xxxx'
+		cache['b'] = 'xxxx'
+		cache['c'] = 'xx'
+		self.assertEquals(10, cache.used)
+		cache['a'] = 'xxxxx'
+		self.assertEquals(['c', 'a'], cache.keys())
+		self.assertEquals(7, cache.used)
+		cache['d'] = 'x' * 11
+		self.assertEquals(['c', 'a'], cache.keys())
+		del cache['c']
+		self.assertEquals({'size': 1, 'capacity': 10, 'used': 5,
+				   'hits': 0, 'misses': 0, 'evictions': 2},
+				  cache.stats())
+		cache.clear()
+		self.assertEquals(0, cache.used)
+
+suite = unittest.makeSuite(TestLRU)
+if __name__ == '__main__':
+	sys.argv.append('-v')
+	unittest.main()
@@ -0,0 +1,535 @@
+#!/usr/bin/env python2.6
+import unittest
+import os, sys, shutil, errno
+from os.path import dirname, abspath, join
+rox_lib = dirname(dirname(dirname(abspath(sys.argv[0]))))
+sys.path.insert(0, join(rox_lib, 'python'))
+
+from rox import basedir, mime, tasks, g
+
+test_dir = '/tmp/rox-mime-test'
+
+test_package = """<?xml version="1.0"?>
+<mime-info xmlns="http://www.freedesktop.org/standards/shared-mime-info">
+  <mime-type type="application/x-rox-test">
+    <comment>ROX test file</comment>
+    <glob pattern="*.roxtest"/>
+    <glob pattern="roxtest-*.log"/>
+    <glob pattern="ROXLITERAL"/>
+    <alias type="application/x-rox-old"/>
+    <magic priority="60">
+      <match type="string" offset="0" value="ROXTEST"/>
+      <match type="string" offset="4:20" value="ROXRANGE"/>
+      <match type="big32" offset="0" value="0x524f5800" mask="0xffffff00">
+        <match type="string" offset="8" value="MASKED"/>
+      </match>
+    </magic>
+  </mime-type>
+  <mime-type type="application/x-rox-low">
+    <comment>Low priority test file</comment>
+    <sub-class-of type="application/x-rox-old"/>
+    <glob pattern="*.roxlow"/>
+    <magic priority="20">
+      <match type="string" offset="0" value="ROXLOW"/>
+    </magic>
+  </mime-type>
+</mime-info>
+"""
+
+new_package = """<?xml version="1.0"?>
+<mime-info xmlns="http://www.freedesktop.org/standards/shared-mime-info">
+  <mime-type type="application/x-rox-new">
+    <comment>New test file</comment>
+    <glob pattern="*.roxnew"/>
+  </mime-type>
+</mime-info>
+"""
+
+class TestMIME(unittest.TestCase):
+	def setUp(self):
+		if os.path.isdir(test_dir):
+			shutil.rmtree(test_dir)
+		os.environ['XDG_DATA_HOME'] = join(test_dir, 'share')
+		os.environ['XDG_DATA_DIRS'] = join(test_dir, 'share.2')
+		os.environ['XDG_CACHE_HOME'] = join(test_dir, 'cache')
+		reload(basedir)
+
+		self.install('rox-test', test_package)
+		mime._cache_uptodate = False
+
+	def tearDown(self):
+		mime.set_auto_reload(None)
+		shutil.rmtree(test_dir)
+
+	def install(self, name, package):
+		packages = basedir.save_data_path('mime', 'packages')
+		file(join(packages, name + '.xml'), 'w').write(package)
+		if os.spawnlp(os.P_WAIT, 'update-mime-database',
+			      'update-mime-database',
+			      basedir.save_data_path('mime')):
+			raise Exception('update-mime-database failed')
+
+	def write(self, leaf, data):
+		path = join(test_dir, leaf)
+		file(path, 'wb').write(data)
+		return path
+
+	def checkDatabase(self):
+		by_name = mime.get_type_by_name
+		self.assertEquals('application/x-rox-test',
+				  str(by_name('foo.roxtest')))
+		self.assertEquals('application/x-rox-test',
+				  str(by_name('FOO.ROXTEST')))
+		self.assertEquals('application/x-rox-test',
+				  str(by_name('/some/dir/roxtest-1.log')))
+		self.assertEquals('application/x-rox-test',
+				  str(by_name('ROXLITERAL')))
+		self.assertEquals(None, by_name('foo.unknown'))
+		self.assertEquals('application/x-rox-test',
+				  str(by_name(u'caf\xe9.roxtest')))
+		self.assertEquals('application/x-rox-test',
+				  str(by_name('caf\xc3\xa9.ROXTEST')))
+		self.assertEquals(None, by_name(u'caf\xe9.unknown'))
+		self.assertEquals(mime.text,
+			mime.get_type(join(test_dir, u'caf\xe9.unknown')))
+
+		by_contents = mime.get_type_by_contents
+		self.assertEquals('application/x-rox-test',
+			str(by_contents(self.write('a', 'ROXTEST data'))))
+		self.assertEquals('application/x-rox-test',
+			str(by_contents(self.write('b', 'xxxxxxxxxxROXRANGE'))))
+		self.assertEquals('application/x-rox-test',
+			str(by_contents(self.write('c', 'ROX\x07....MASKED'))))
+		self.assertEquals(None,
+			by_contents(self.write('d', 'ROX\x07....NOMASK')))
+		self.assertEquals(None,
+			by_contents(self.write('e', 'xxxxxxxxxxxxxxxxxxxxxxROXRANGE')))
+		self.assertEquals(None, by_contents(self.write('f', '')))
+
+		low = self.write('g.roxtest', 'ROXLOW')
+		self.assertEquals('application/x-rox-low',
+				  str(by_contents(low)))
+		self.assertEquals(None, by_contents(low, min_pri=50))
+		self.assertEquals('application/x-rox-test',
+				  str(mime.get_type(low, name_pri=50)))
+
+		rox_low = mime.lookup('application/x-rox-low')
+		rox_test = mime.lookup('application/x-rox-test')
+		self.assertEquals('application/x-rox-test',
+				  mime.resolve_alias('application/x-rox-old'))
+		self.assertEquals(rox_test,
+			mime.lookup('application/x-rox-old').get_canonical())
+		self.assertEquals([rox_test], rox_low.get_ancestors())
+		assert rox_low.is_subclass_of(rox_test)
+		assert rox_low.is_subclass_of('application/x-rox-old')
+		assert rox_low.is_subclass_of('application/*')
+		assert rox_low.is_subclass_of('application/octet-stream')
+		assert not rox_test.is_subclass_of(rox_low)
+		assert not rox_low.is_subclass_of('text/plain')
+		assert mime.lookup('text/x-rox').is_subclass_of('text/plain')
+		assert not mime.inode_dir.is_subclass_of('application/octet-stream')
+
+	def testData(self):
+		import mmap
+		from StringIO import StringIO
+		by_data = mime.get_type_by_data
+		self.assertEquals('application/x-rox-test',
+				  str(by_data('ROXTEST data')))
+		self.assertEquals('application/x-rox-test',
+				  str(by_data(buffer('xxxxxxxxxxROXRANGE'))))
+		self.assertEquals(None, by_data(''))
+		self.assertEquals('application/x-rox-low',
+				  str(by_data('ROXLOW')))
+		self.assertEquals('application/x-rox-test',
+				  str(by_data('ROXLOW', 'a.roxtest', name_pri=50)))
+		self.assertEquals('application/x-rox-low',
+				  str(by_data('', 'a.roxlow')))
+
+		path = self.write('a', 'ROXTEST' + 'x' * 100000)
+		stream = file(path)
+		m = mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ)
+		self.assertEquals('application/x-rox-test', str(by_data(m)))
+		m.close()
+
+		self.assertEquals('application/x-rox-test',
+				  str(mime.get_type_by_stream(stream)))
+		assert 0 < stream.tell() < 100000
+		self.assertEquals('application/x-rox-test',
+			str(mime.get_type_by_stream(StringIO('ROXTEST'))))
+
+	def testCache(self):
+		self.checkDatabase()
+		self.assertEquals(1, len(mime.caches))
+		self.assertEquals('application/x-rox-test',
+			mime.caches[0].resolve_alias('application/x-rox-old'))
+		self.assertEquals(None,
+			mime.caches[0].resolve_alias('application/x-rox-test'))
+
+	def testText(self):
+		os.unlink(join(basedir.xdg_data_home, 'mime', 'mime.cache'))
+		self.checkDatabase()
+		self.assertEquals([], mime.caches)
+
+	def testLazyLoading(self):
+		os.unlink(join(basedir.xdg_data_home, 'mime', 'mime.cache'))
+		mime.get_type_by_name('foo.roxtest')
+		assert mime._globs_loaded
+		assert not mime._magic_loaded
+		mime.get_type_by_contents(self.write('a', 'ROXTEST'))
+		assert mime._magic_loaded
+		assert isinstance(mime.exts['roxtest'], str)
+
+	def testAutoReload(self):
+		self.assertEquals(None, mime.get_type_by_name('a.roxnew'))
+		mime.set_auto_reload(0)
+		self.install('rox-new', new_package)
+		self.assertEquals('application/x-rox-new',
+				  str(mime.get_type_by_name('a.roxnew')))
+
+	def testBackgroundReload(self):
+		self.assertEquals(None, mime.get_type_by_name('a.roxnew'))
+		mime.set_auto_reload(0, background = True)
+		self.install('rox-new', new_package)
+		# Old tables are used until the new ones are ready
+		self.assertEquals(None, mime.get_type_by_name('a.roxnew'))
+		reload_task = mime._reload_task
+		def run():
+			yield reload_task.finished
+			self.assertEquals('application/x-rox-new',
+				str(mime.get_type_by_name('a.roxnew')))
+			g.main_quit()
+		tasks.Task(run())
+		g.main()
+
+	def testBackgroundReloadRace(self):
+		cache = join(basedir.xdg_data_home, 'mime', 'mime.cache')
+		os.unlink(cache)
+		mime.get_type_by_contents(self.write('a', 'ROXTEST'))
+		assert not mime._globs_loaded
+		self.install('rox-new', new_package)
+		os.unlink(cache)
+
+		reload = mime._reload_in_background()
+		reload.next()
+		reload.next()		# New magic read
+		# The globs are loaded while the new tables are being built
+		self.assertEquals('application/x-rox-test',
+				  str(mime.get_type_by_name('a.roxtest')))
+		for x in reload: pass
+		assert mime._globs_loaded
+		self.assertEquals('application/x-rox-new',
+				  str(mime.get_type_by_name('a.roxnew')))
+		self.assertEquals(mime._database_stamp(), mime._db_stamp)
+
+	def testComments(self):
+		mime._comments = None
+		t = mime.lookup('application/x-rox-low')
+		t._comment = None
+		self.assertEquals('Low priority test file', t.get_comment())
+		cache_file = join(test_dir, 'cache', 'rox.sourceforge.net',
+				  'mime-comments')
+		assert os.path.exists(cache_file)
+
+		# Loaded from the saved index next time
+		mime._comments = None
+		self.assertEquals('ROX test file',
+			mime._get_comments()['application/x-rox-test'])
+
+	def testStaleCache(self):
+		globs = join(basedir.xdg_data_home, 'mime', 'globs')
+		os.utime(globs, (2000000000, 2000000000))
+		self.checkDatabase()
+		self.assertEquals([], mime.caches)
+
+	def testScanDirectory(self):
+		dir = join(test_dir, 'scan')
+		os.mkdir(dir)
+		os.mkdir(join(dir, 'subdir'))
+		file(join(dir, 'a.roxtest'), 'w').write('ROXLOW')
+		file(join(dir, 'b'), 'w').write('ROXTEST')
+		file(join(dir, 'c'), 'w').write('')
+		expected = {'a.roxtest': 'application/x-rox-test',
+			    'b': 'application/x-rox-test',
+			    'c': 'text/plain',
+			    'subdir': 'inode/directory'}
+		self.assertEquals(expected,
+			dict([(leaf, str(t)) for leaf, t in
+			      mime.scan_directory(dir, name_pri=50)]))
+
+		paths = [join(dir, 'b'), join(dir, 'missing.roxlow')]
+		self.assertEquals([(paths[0], 'application/x-rox-test'),
+				   (paths[1], 'application/x-rox-low')],
+			[(p, str(t)) for p, t in mime.get_types(paths)])
+
+	def testParallel(self):
+		dir = join(test_dir, 'tree')
+		os.makedirs(join(dir, 'sub'))
+		paths = []
+		for i in range(20):
+			path = join(dir, ['', 'sub'][i % 2], str(i))
+			file(path, 'w').write(['ROXTEST', 'ROXLOW'][i % 2])
+			paths.append(path)
+		expected = [(p, str(t)) for p, t in mime.get_types(paths)]
+		self.assertEquals(expected, [(p, str(t)) for p, t in
+			mime.get_types_parallel(paths, processes = 2,
+						chunksize = 3)])
+		self.assertEquals(sorted(expected), sorted([(p, str(t))
+			for p, t in mime.walk_types(dir, processes = 2,
+					ordered = False, chunksize = 3)]))
+
+	def testXattrWrite(self):
+		from rox import xattr
+		path = self.write('a', 'ROXTEST')
+		try:
+			xattr.set(path, 'user.rox_test', 'test')
+		except OSError:
+			return		# No xattr support here
+		mime.set_xattr_write(True)
+		try:
+			self.assertEquals('application/x-rox-test',
+					  str(mime.get_type(path)))
+		finally:
+			mime.set_xattr_write(False)
+		self.assertEquals('application/x-rox-test',
+				  xattr.get(path, xattr.USER_MIME_TYPE))
+		assert xattr.get(path, xattr.ROX_MIME_TYPE_STAMP)
+
+		# The stored type is used while the file is unchanged
+		xattr.set(path, xattr.USER_MIME_TYPE, 'application/x-rox-low')
+		self.assertEquals('application/x-rox-low',
+				  str(mime.get_type(path)))
+
+		# ... but ignored after it changes
+		file(path, 'a').write('more data')
+		self.assertEquals('application/x-rox-test',
+				  str(mime.get_type(path)))
+		xattr.set(path, xattr.ROX_MIME_TYPE_STAMP, 'garbage')
+		self.assertEquals('application/x-rox-test',
+				  str(mime.get_type(path)))
+
+		# Types set by the user have no stamp and are always used
+		xattr.delete(path, xattr.ROX_MIME_TYPE_STAMP)
+		self.assertEquals('application/x-rox-low',
+				  str(mime.get_type(path)))
+
+	def testXattrWriteSniffedOnly(self):
+		from rox import xattr
+		by_name = self.write('b.roxtest', 'Nothing special')
+		try:
+			xattr.set(by_name, 'user.rox_test', 'test')
+		except OSError:
+			return		# No xattr support here
+		sniffed = self.write('b.roxnew', 'ROXTEST')
+		mime.set_xattr_write(True)
+		mime.set_type_cache(10)
+		try:
+			self.assertEquals('application/x-rox-test',
+					  str(mime.get_type(by_name)))
+			self.assertEquals(None,
+				xattr.get(by_name, xattr.USER_MIME_TYPE))
+			self.assertEquals('application/x-rox-test',
+					  str(mime.get_type(sniffed)))
+			self.assertEquals('application/x-rox-test',
+				xattr.get(sniffed, xattr.USER_MIME_TYPE))
+
+			# Storing the type doesn't spoil the cached result
+			mime.get_type(sniffed)
+			self.assertEquals(1, mime.get_type_cache_stats()['hits'])
+
+			# The stored type isn't used after a rename
+			xattr.set(sniffed, xattr.USER_MIME_TYPE,
+				  'application/x-rox-low')
+			renamed = join(test_dir, 'c.roxtest')
+			os.rename(sniffed, renamed)
+			self.assertEquals('application/x-rox-test',
+					  str(mime.get_type(renamed)))
+		finally:
+			mime.set_xattr_write(False)
+			mime.set_type_cache(0)
+
+	def testXattrWriteLinks(self):
+		from rox import xattr
+		target = self.write('e', 'ROXTEST')
+		try:
+			xattr.set(target, 'user.rox_test', 'test')
+		except OSError:
+			return		# No xattr support here
+		link = join(test_dir, 'e.link')
+		os.symlink('e', link)
+		hard = self.write('f', 'ROXTEST')
+		os.link(hard, join(test_dir, 'f.link'))
+		mime.set_xattr_write(True)
+		try:
+			# Nothing is stored through a symlink or on a hard link,
+			# where the stamp wouldn't match the other names
+			for i in range(2):
+				self.assertEquals('application/x-rox-test',
+						  str(mime.get_type(link)))
+				self.assertEquals('application/x-rox-test',
+						  str(mime.get_type(hard)))
+			self.assertEquals(None,
+				xattr.get(target, xattr.USER_MIME_TYPE))
+			self.assertEquals(None,
+				xattr.get(hard, xattr.USER_MIME_TYPE))
+
+			# A type stored using the file's own name is still used
+			# through a symlink with the same name
+			mime.get_type(target)
+			xattr.set(target, xattr.USER_MIME_TYPE,
+				  'application/x-rox-low')
+			os.mkdir(join(test_dir, 'links'))
+			same = join(test_dir, 'links', 'e')
+			os.symlink(target, same)
+			ctime = os.stat(target).st_ctime
+			self.assertEquals('application/x-rox-low',
+					  str(mime.get_type(same)))
+			self.assertEquals('application/x-rox-test',
+					  str(mime.get_type(link)))
+			self.assertEquals(ctime, os.stat(target).st_ctime)
+		finally:
+			mime.set_xattr_write(False)
+
+	def testXattrWriteDenied(self):
+		from rox import xattr
+		path = self.write('d', 'ROXTEST')
+		calls = []
+		def denied(path, name, value):
+			calls.append(name)
+			raise OSError(errno.EACCES, 'Permission denied')
+		old_set, old_supported = xattr.set, xattr.supported
+		xattr.set = denied
+		xattr.supported = lambda path: True
+		mime.set_xattr_write(True)
+		try:
+			for i in range(3):
+				self.assertEquals('application/x-rox-test',
+						  str(mime.get_type(path)))
+			self.assertEquals(1, len(calls))
+			# Tried again after a permission change
+			os.chmod(path, 0600)
+			mime.get_type(path)
+			self.assertEquals(2, len(calls))
+		finally:
+			xattr.set, xattr.supported = old_set, old_supported
+			mime.set_xattr_write(False)
+
+	def testTypeCache(self):
+		path = self.write('cached', 'ROXTEST')
+		mime.set_type_cache(2)
+		try:
+			self.assertEquals('application/x-rox-test',
+					  str(mime.get_type(path)))
+			self.assertEquals('application/x-rox-test',
+					  str(mime.get_type(path)))
+			stats = mime.get_type_cache_stats()
+			self.assertEquals((1, 1), (stats['hits'], stats['misses']))
+
+			file(path, 'w').write('ROXLOW and more')
+			self.assertEquals('application/x-rox-low',
+					  str(mime.get_type(path)))
+			stats = mime.get_type_cache_stats()
+			self.assertEquals((1, 2), (stats['hits'], stats['misses']))
+		finally:
+			mime.set_type_cache(0)
+		self.assertEquals(None, mime.get_type_cache_stats())
+
+	def testGlobMatcher(self):
+		globs = mime.GlobMatcher()
+		globs.add('*.a*', 'short')
+		globs.add('*.abc*', 'long')
+		globs.add('x*', 'heavy', weight = 80)
+		globs.add('*.B?', 'upper', case_sensitive = True)
+		globs.add('[0-9]*', 'digit')
+		for i in range(200):
+			globs.add('*.%d?' % i, 'num')
+		self.assertEquals('long', globs.match('foo.ABCD'))
+		self.assertEquals('short', globs.match('foo.a1'))
+		self.assertEquals('heavy', globs.match('x.abcd'))
+		self.assertEquals('upper', globs.match('foo.Bx'))
+		self.assertEquals(None, globs.match('foo.bx'))
+		self.assertEquals('num', globs.match('a.199z'))
+		self.assertEquals('digit', globs.match('1.foo'))
+		self.assertEquals(None, globs.match('foo'))
+
+	def testMagicProgram(self):
+		prog = mime.MagicProgram()
+		prog.add(0, 0, 'AB')
+		prog.add(1, 2, 'C')
+		prog.add(2, 3, 'D')
+		prog.add(1, 2, 'E')
+		prog.add(0, 0, 'X', '\xf0')
+		prog.finish()
+		self.assertEquals([4, 3, 3, 4, 5], list(prog.skips))
+		assert prog.match('ABCD')
+		assert prog.match('ABE')
+		assert not prog.match('ABC')
+		assert not prog.match('AB')
+		assert prog.match('Z')
+		assert not prog.match('\x01')
+
+	def testMagicIndex(self):
+		index = mime.MagicIndex()
+		index.add(0, [(0, 1, 'GIF8', None), (0, 1, 'PNG', None)])
+		index.add(1, [(2, 10, 'RANGE', None)])
+		index.add(2, [(0, 1, 'X', 0xf0)])
+		index.add(3, [(4, 1, 'LONGER VALUE', None)])
+		self.assertEquals([0, 2], index.candidates('GIF89a'))
+		self.assertEquals([0, 2], index.candidates('PNG'))
+		self.assertEquals([1, 2], index.candidates('....xxRANGE'))
+		self.assertEquals([2, 3], index.candidates('....LONGxxx'))
+		self.assertEquals([2], index.candidates(''))
+
+	def testMagicStats(self):
+		db = mime.MagicDB()
+		for name, value in [('text/x-a', 'AB'), ('text/x-b', 'ABC'),
+				    ('text/x-c', 'X')]:
+			t = mime.MagicType(name)
+			t.program.add(0, 0, value)
+			t.finish()
+			db.types.setdefault(50, []).append(t)
+		self.assertEquals(None, db.get_stats())
+		db.set_stats(reorder_interval = 4)
+		for i in range(4):
+			self.assertEquals((50, 'text/x-c'), db.match_data('X'))
+		stats = db.get_stats()
+		self.assertEquals(4, stats['calls'])
+		self.assertEquals({'text/x-c': 4}, stats['hits'])
+		self.assertEquals(1, stats['reorders'])
+
+		# text/x-c is now tested first, and text/x-a can't also match
+		db.match_data('X')
+		stats = db.get_stats()
+		self.assertEquals(5, stats['types_tested'])
+		self.assertEquals(5, stats['rules_tested'])
+		self.assertEquals(5, stats['bytes_compared'])
+
+		# Ties still go to the first type in the file
+		self.assertEquals((50, 'text/x-a'), db.match_data('ABC'))
+		db.set_stats(False)
+		self.assertEquals((50, 'text/x-a'), db.match_data('ABC'))
+		self.assertEquals(None, db.get_stats())
+
+	def testMagicStatsCache(self):
+		mime.get_type_by_name('a.roxtest')
+		assert mime.caches
+		mime.set_magic_stats(True, reorder_interval = 2)
+		try:
+			self.checkDatabase()
+			path = self.write('h', 'ROXTEST')
+			for i in range(3):
+				self.assertEquals('application/x-rox-test',
+					str(mime.get_type_by_contents(path)))
+			stats = mime.get_magic_stats()
+			assert stats['calls'] > 0
+			assert stats['types_tested'] > 0
+			assert stats['reorders'] > 0
+			self.assertEquals(3 + 3,
+				stats['hits']['application/x-rox-test'])
+		finally:
+			mime.set_magic_stats(False)
+		self.assertEquals(None, mime.get_magic_stats())
+
+suite = unittest.makeSuite(TestMIME)
+if __name__ == '__main__':
+	sys.argv.append('-v')
+	unittest.main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python2.6
+import unittest
+import os, sys, shutil, struct, zlib
+from os.path import dirname, abspath, join
+rox_lib = dirname(dirname(dirname(abspath(sys.argv[0]))))
+sys.path.insert(0, join(rox_lib, 'python'))
+
+from rox import basedir, thumbnail, tasks, g
+
+test_dir = '/tmp/rox-thumbnail-test'
+
+def png_chunk(ctype, data):
+	crc = zlib.crc32(ctype + data) & 0xffffffff
+	return struct.pack('>L', len(data)) + ctype + data + struct.pack('>L', crc)
+
+def make_png(text, ztext = {}):
+	"""A 1x1 PNG image with the given text."""
+	png = '\x89PNG\r\n\x1a\n'
+	png += png_chunk('IHDR', struct.pack('>LLBBBBB', 1, 1, 8, 0, 0, 0, 0))
+	for key, value in text.items():
+		png += png_chunk('tEXt', key + '\0' + value)
+	for key, value in ztext.items():
+		png += png_chunk('zTXt', key + '\0\0' + zlib.compress(value))
+	png += png_chunk('IDAT', zlib.compress('\0\0'))
+	png += png_chunk('tEXt', 'After\0image')
+	return png + png_chunk('IEND', '')
+
+class Image:
+	"""Enough of a pixbuf for Thumbnailer.run()."""
+	def __init__(self, w, h, scaled = 0):
+		self.w = w
+		self.h = h
+		self.scaled = scaled
+	def get_width(self): return self.w
+	def get_height(self): return self.h
+	def scale_simple(self, w, h, interp):
+		return Image(w, h, self.scaled + 1)
+	def save(self, path, format, options):
+		file(path, 'w').write('%dx%d %d' % (self.w, self.h, self.scaled))
+
+class ImageThumbnailer(thumbnail.Thumbnailer):
+	def __init__(self):
+		thumbnail.Thumbnailer.__init__(self, 'Test', 'test')
+		self.loads = []
+	def get_image(self, inname, rsize):
+		self.loads.append(rsize)
+		return Image(1000, 500)
+
+class BrokenThumbnailer(thumbnail.Thumbnailer):
+	def __init__(self):
+		thumbnail.Thumbnailer.__init__(self, 'Test', 'test')
+	def get_image(self, inname, rsize):
+		raise Exception('Corrupt image')
+
+class TestThumbnail(unittest.TestCase):
+	def setUp(self):
+		if os.path.isdir(test_dir):
+			shutil.rmtree(test_dir)
+		os.makedirs(join(test_dir, 'files'))
+		os.environ['HOME'] = test_dir
+		os.environ['XDG_CONFIG_HOME'] = join(test_dir, 'config')
+		reload(basedir)
+
+		thumbs = basedir.save_config_path('rox.sourceforge.net',
+						  'MIME-thumb')
+		script = join(thumbs, 'text_plain')
+		file(script, 'w').write('#!/bin/sh\n'
+			'grep -q bad "$1" && exit 1\n'
+			'echo "$3" > "$2"\n')
+		os.chmod(script, 0755)
+
+	def tearDown(self):
+		shutil.rmtree(test_dir)
+
+	def write(self, leaf, data):
+		path = join(test_dir, 'files', leaf)
+		file(path, 'w').write(data)
+		return path
+
+	def testQueue(self):
+		service = thumbnail.ThumbnailService(0)
+		a = service.request('a.txt')
+		b = service.request('b.txt', priority = 5)
+		a2 = service.request('a.txt', priority = 1)
+		c = service.request('c.txt')
+		self.assertEquals(abspath('a.txt'), a.path)
+		assert a._job is a2._job
+
+		c.cancel()
+		assert c.happened and c.cancelled
+		self.assertEquals(None, c.thumbnail)
+		c.cancel()
+
+		self.assertEquals(abspath('b.txt'), service._next_job().path)
+		self.assertEquals(abspath('a.txt'), service._next_job().path)
+		self.assertEquals(None, service._next_job())
+
+	def testPriority(self):
+		service = thumbnail.ThumbnailService(0)
+		a = service.request('a.txt', priority = 1)
+		b = service.request('b.txt', priority = 2)
+		a.set_priority(3)
+		self.assertEquals(abspath('a.txt'), service._next_job().path)
+		self.assertEquals(abspath('b.txt'), service._next_job().path)
+		self.assertEquals(None, service._next_job())
+
+	def testGenerate(self):
+		service = thumbnail.ThumbnailService(1)
+		a = self.write('a.txt', 'Hello')
+		b = self.write('b.txt', 'World')
+		requests = [service.request(a), service.request(b),
+			    service.request(a, 256)]
+		requests.append(service.request(a))
+		def run():
+			for r in requests:
+				yield r
+			g.main_quit()
+		tasks.Task(run())
+		g.main()
+
+		for r in requests:
+			self.assertEquals(0, r.status)
+		self.assertEquals(thumbnail.get_path_save(a), requests[0].thumbnail)
+		self.assertEquals(requests[0].thumbnail, requests[3].thumbnail)
+		self.assertEquals(thumbnail.get_path_save(a, 'large'),
+				  requests[2].thumbnail)
+		self.assertEquals('128\n', file(requests[1].thumbnail).read())
+		self.assertEquals('256\n', file(requests[2].thumbnail).read())
+
+	def testDeletedWhileQueued(self):
+		service = thumbnail.ThumbnailService(1)
+		a = self.write('a.txt', 'Hello')
+		b = self.write('b.txt', 'World')
+		requests = [service.request(a), service.request(b)]
+		os.unlink(a)
+		def run():
+			for r in requests:
+				yield r
+			g.main_quit()
+		tasks.Task(run())
+		g.main()
+		self.assertEquals(1, requests[0].status)
+		self.assertEquals(None, requests[0].thumbnail)
+		self.assertEquals(0, requests[1].status)
+		self.assertEquals(thumbnail.get_path_save(b), requests[1].thumbnail)
+		self.assertEquals({}, service._jobs)
+
+	def testGenerateDeleted(self):
+		path = self.write('gone.txt', 'Hello')
+		os.unlink(path)
+		self.assertEquals(1, thumbnail.generate(path))
+		assert not os.path.exists(thumbnail.get_path_save(path))
+
+	def testNoMethod(self):
+		r = thumbnail.ThumbnailService().request(join(test_dir, 'files'))
+		def run():
+			yield r
+			g.main_quit()
+		tasks.Task(run())
+		g.main()
+		self.assertEquals(None, r.status)
+		self.assertEquals(None, r.thumbnail)
+
+	def make_thumbnail(self, path, ttype = 'normal'):
+		"""Write a thumbnail for path, and return its path."""
+		s = os.stat(path)
+		thumb = thumbnail.get_path_save(path, ttype)
+		if not os.path.isdir(dirname(thumb)):
+			os.makedirs(dirname(thumb))
+		file(thumb, 'wb').write(make_png({
+			'Thumb::URI': 'file://' + path,
+			'Thumb::Size': str(s.st_size),
+			'Thumb::MTime': str(s.st_mtime)}))
+		return thumb
+
+	def testReadText(self):
+		path = join(test_dir, 'test.png')
+		file(path, 'wb').write(make_png({'Thumb::MTime': '10'},
+						{'Thumb::URI': 'file:///a'}))
+		self.assertEquals({'Thumb::MTime': '10',
+				   'Thumb::URI': 'file:///a'},
+				  thumbnail.read_png_text(path))
+		self.assertEquals(None, thumbnail.read_png_text(__file__))
+		self.assertEquals(None, thumbnail.read_png_text('/missing'))
+
+	def testValidPath(self):
+		path = self.write('a.txt', 'Hello')
+		self.assertEquals(None, thumbnail.get_valid_path(path))
+		thumb = self.make_thumbnail(path)
+		self.assertEquals(thumb, thumbnail.get_path(path))
+		self.assertEquals(thumb, thumbnail.get_valid_path(path))
+		file(path, 'a').write(' world')
+		self.assertEquals(thumb, thumbnail.get_path(path))
+		self.assertEquals(None, thumbnail.get_valid_path(path))
+
+	def testIndex(self):
+		path = self.write('a.txt', 'Hello')
+		self.assertEquals(None, thumbnail.get_image(path))
+		thumb = self.make_thumbnail(path)
+		image = thumbnail.get_image(path)
+		assert image
+		assert thumbnail.get_image(path) is image
+
+		# A new thumbnail replaces the loaded one
+		os.utime(thumb, (1, 1))
+		image2 = thumbnail.get_image(path)
+		assert image2 and image2 is not image
+
+		# The loaded one isn't used once the file changes
+		os.utime(path, (1, 1))
+		self.assertEquals(None, thumbnail.get_image(path))
+
+	def write_fail_marker(self, path, name):
+		s = os.stat(path)
+		marker = thumbnail.get_path_save(path, join('fail', name))
+		os.makedirs(dirname(marker))
+		file(marker, 'wb').write(make_png({
+			'Thumb::Size': str(s.st_size),
+			'Thumb::MTime': str(s.st_mtime)}))
+		return marker
+
+	def testFailMarker(self):
+		path = self.write('a.txt', 'Hello')
+		marker = self.write_fail_marker(path, 'pixbuf')
+		self.assertEquals(marker, thumbnail.get_fail_path(path))
+		assert thumbnail.has_failed(path)
+
+		self.assertEquals(1, thumbnail.generate(path))
+		self.assertEquals(None, thumbnail.get_path(path))
+
+		# Try again once the file changes
+		file(path, 'w').write('Hello again')
+		assert not thumbnail.has_failed(path)
+		self.assertEquals(0, thumbnail.generate(path))
+		assert thumbnail.get_path(path)
+
+	def testForeignFailMarker(self):
+		path = self.write('a.txt', 'Hello')
+		marker = self.write_fail_marker(path, 'other-app-1.0')
+		self.assertEquals(None, thumbnail.get_fail_path(path))
+		assert not thumbnail.has_failed(path)
+
+		thumbnail.trust_fail_markers('other-app-1.0')
+		try:
+			self.assertEquals(marker, thumbnail.get_fail_path(path))
+			assert thumbnail.has_failed(path)
+		finally:
+			thumbnail._fail_names.discard('other-app-1.0')
+
+	def testFailureCache(self):
+		path = self.write('a.txt', 'bad file')
+		assert not thumbnail.has_failed(path)
+		self.assertEquals(1, thumbnail.generate(path))
+		assert thumbnail.has_failed(path)
+		self.assertEquals(None, thumbnail.get_fail_path(path))
+
+		r = thumbnail.ThumbnailService().request(path)
+		def run():
+			yield r
+			g.main_quit()
+		tasks.Task(run())
+		g.main()
+		self.assertEquals(1, r.status)
+		self.assertEquals(None, r.thumbnail)
+
+		file(path, 'w').write('good file')
+		assert not thumbnail.has_failed(path)
+		self.assertEquals(0, thumbnail.generate(path))
+
+	def testLoadError(self):
+		path = self.write('a.png', 'Not a PNG')
+		th = BrokenThumbnailer()
+		th.run(path)
+		assert th.failed
+
+		old = thumbnail.get_method, thumbnail.GdkPixbufThumbnailer
+		thumbnail.get_method = lambda path: True
+		thumbnail.GdkPixbufThumbnailer = BrokenThumbnailer
+		try:
+			self.assertEquals(1, thumbnail.generate(path))
+			assert thumbnail.has_failed(path)
+			self.assertEquals(1, thumbnail.generate(path))
+		finally:
+			thumbnail.get_method, thumbnail.GdkPixbufThumbnailer = old
+
+	def testSizes(self):
+		path = self.write('a.txt', 'Hello')
+		th = ImageThumbnailer()
+		th.run(path, None, thumbnail.NORMAL, (thumbnail.LARGE,))
+		self.assertEquals([256], th.loads)
+		self.assertEquals('256x128 1', file(thumbnail.get_path_save(path,
+						'large')).read())
+		self.assertEquals('128x64 2', file(thumbnail.get_path_save(path,
+						'normal')).read())
+
+		self.assertEquals((thumbnail.LARGE,),
+			thumbnail._extra_sizes(path, thumbnail.NORMAL, True))
+		self.assertEquals((),
+			thumbnail._extra_sizes(path, thumbnail.NORMAL, False))
+		self.make_thumbnail(path, 'large')
+		self.assertEquals((),
+			thumbnail._extra_sizes(path, thumbnail.NORMAL, True))
+
+	def testClean(self):
+		files = [self.write(leaf, 'data') for leaf in 'abcdef']
+		thumbs = [self.make_thumbnail(f) for f in files]
+		marker = self.make_thumbnail(files[5], join('fail', 'app'))
+		os.unlink(files[1])
+		os.unlink(files[5])
+		file(files[2], 'w').write('changed')
+		file(thumbs[3], 'w').write('garbage')
+		remote = thumbnail.get_path_save('/remote', 'large')
+		os.makedirs(dirname(remote))
+		file(remote, 'wb').write(make_png({
+			'Thumb::URI': 'http://example.com/a',
+			'Thumb::MTime': '1'}))
+		for i, path in enumerate(thumbs + [remote]):
+			os.utime(path, (1000 + i, 1000))
+
+		stats = thumbnail.clean_cache(dry_run = True)
+		self.assertEquals(8, stats['scanned'])
+		self.assertEquals(3, stats['kept'])
+		for i, path in enumerate(thumbs + [remote]):
+			assert os.path.exists(path)
+			# Reading them didn't make them look recently used
+			self.assertEquals(1000 + i, os.stat(path).st_atime)
+		assert os.path.exists(marker)
+
+		cleaner = thumbnail.ThumbnailCleaner(
+			max_bytes = os.path.getsize(remote), chunk = 2)
+		def run():
+			yield cleaner.start().finished
+			g.main_quit()
+		tasks.Task(run())
+		g.main()
+		stats = cleaner.stats
+		self.assertEquals(3, stats['removed_missing'])
+		self.assertEquals(1, stats['removed_stale'])
+		self.assertEquals(1, stats['removed_invalid'])
+		self.assertEquals(2, stats['removed_budget'])
+		self.assertEquals(1, stats['kept'])
+		self.assertEquals(stats['bytes_scanned'],
+				  stats['bytes_freed'] + stats['bytes_kept'])
+		self.assertEquals([remote], [p for p in thumbs + [marker, remote]
+					     if os.path.exists(p)])
+
+		# Thumbnails which haven't been used recently
+		self.make_thumbnail(files[0])
+		os.utime(remote, (1, 1))
+		stats = thumbnail.clean_cache(max_age = 60)
+		self.assertEquals(1, stats['removed_age'])
+		self.assertEquals(1, stats['kept'])
+
+suite = unittest.makeSuite(TestThumbnail)
+if __name__ == '__main__':
+	sys.argv.append('-v')
+	unittest.main()